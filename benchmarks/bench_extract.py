@@ -0,0 +1,83 @@
+import argparse, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from hnarchive import open_archive
+from hntext import extract_file, extract_files
+
+# Compare the streaming text extractor with the BeautifulSoup path that
+# analyze_posts used before, on real crawl archives
+#
+# python benchmarks/bench_extract.py crawl-0-0.tar.gz [crawl-1-0.tar.gz ...]
+#
+# Download archives of a crawl run first, e.g. with
+# Flow("HNSentimentCrawl").latest_successful_run.data.tarballs and S3.get.
+# Requires beautifulsoup4.
+
+
+def soup_words(path, max_words):
+    from bs4 import BeautifulSoup  # pylint: disable=import-error
+
+    with open(path) as f:
+        soup = BeautifulSoup(f.read(), "html.parser")
+    return soup.get_text().split()[:max_words]
+
+
+def run(name, fn, paths, nbytes):
+    t = time.time()
+    out = dict(fn(paths))
+    t = time.time() - t
+    print(
+        f"{name:<20} {len(paths) / t:8.1f} docs/s {nbytes / t / 1024**2:8.1f} MB/s "
+        f"ok {sum(1 for v in out.values() if v is not None)}"
+    )
+    return out
+
+
+def sequential(fn, max_words):
+    def docs(paths):
+        for key, path in paths:
+            try:
+                yield key, fn(path, max_words)
+            except Exception:
+                yield key, None
+
+    return docs
+
+
+def jaccard(a, b):
+    a, b = set(a), set(b)
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("archives", nargs="+")
+    parser.add_argument("--num-words", type=int, default=5000)
+    parser.add_argument("--processes", type=int, default=None)
+    cfg = parser.parse_args()
+
+    root = tempfile.mkdtemp("bench_extract")
+    for archive in cfg.archives:
+        open_archive(archive).extractall(path=root)
+    datapath = os.path.join(root, "data")
+    paths = [(id, os.path.join(datapath, id)) for id in os.listdir(datapath)]
+    nbytes = sum(os.path.getsize(p) for _, p in paths)
+    print(f"{len(paths)} documents, {nbytes / 1024**2:.1f}MB")
+
+    ref = run("beautifulsoup", sequential(soup_words, cfg.num_words), paths, nbytes)
+    seq = run("streaming", sequential(extract_file, cfg.num_words), paths, nbytes)
+    par = run(
+        "streaming+pool",
+        lambda p: ((k, w) for k, w, _ in extract_files(p, cfg.num_words, cfg.processes)),
+        paths,
+        nbytes,
+    )
+    assert seq == par
+    both = [k for k, v in ref.items() if v is not None and seq.get(k) is not None]
+    exact = sum(1 for k in both if ref[k] == seq[k])
+    sim = sum(jaccard(ref[k], seq[k]) for k in both) / max(1, len(both))
+    print(
+        f"identical output for {exact}/{len(both)} docs, "
+        f"mean word-set jaccard {sim:.3f}"
+    )
+    shutil.rmtree(root)
@@ -0,0 +1,109 @@
+import argparse, os, random, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from hnfetch import Fetcher
+
+# Benchmark the crawl fetch engine against a local stand-in HTTP server
+# that adds artificial latency to every response.
+#
+# python benchmarks/bench_fetch.py --urls 400 --hosts 20 --latency 0.2
+#
+# Hosts are simulated with distinct loopback addresses (127.0.0.x), so
+# per-host rate limits apply exactly like they do on a real crawl.
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        cfg = self.server.cfg
+        time.sleep(max(0, random.gauss(cfg.latency, cfg.latency / 4)))
+        if random.random() < cfg.error_rate:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b"<html><body>" + b"x" * cfg.size + b"</body></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(cfg):
+    server = ThreadingHTTPServer(("0.0.0.0", 0), SlowHandler)
+    server.daemon_threads = True
+    server.cfg = cfg
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_posts(cfg, port):
+    return [
+        (i, f"post {i}", 100, f"http://127.0.0.{1 + i % cfg.hosts}:{port}/{i}")
+        for i in range(cfg.urls)
+    ]
+
+
+def sequential(posts):
+    import requests
+
+    successful, failed = set(), set()
+    for id, _, _, url in posts:
+        try:
+            resp = requests.get(url, allow_redirects=True, timeout=10)
+            resp.raise_for_status()
+            successful.add(id)
+        except:
+            failed.add(id)
+    return successful, failed
+
+
+def concurrent(posts, cfg, concurrency):
+    fetcher = Fetcher(
+        concurrency=concurrency,
+        per_host_rate=cfg.per_host_rate,
+        per_host_inflight=cfg.per_host_concurrency,
+    )
+    successful, failed = set(), set()
+    for (id, _, _, _), _, ex in fetcher.fetch_all(posts):
+        (successful if ex is None else failed).add(id)
+    return successful, failed
+
+
+def report(name, posts, t, successful, failed):
+    print(
+        f"{name:<24} {len(posts) / t:8.1f} urls/s {t:7.2f}s "
+        f"ok {len(successful)} failed {len(failed)}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--urls", type=int, default=400)
+    parser.add_argument("--hosts", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--size", type=int, default=50000)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--per-host-rate", type=float, default=10.0)
+    parser.add_argument("--per-host-concurrency", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--skip-sequential", action="store_true")
+    cfg = parser.parse_args()
+
+    server = start_server(cfg)
+    posts = make_posts(cfg, server.server_address[1])
+    if not cfg.skip_sequential:
+        t = time.time()
+        res = sequential(posts)
+        report("sequential", posts, time.time() - t, *res)
+    for c in cfg.concurrency:
+        t = time.time()
+        res = concurrent(posts, cfg, c)
+        report(f"concurrency={c}", posts, time.time() - t, *res)
+    server.shutdown()
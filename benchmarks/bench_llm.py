@@ -0,0 +1,83 @@
+import argparse, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from hnllm import LLMScheduler
+from mockllm import start_server, CompletionClient
+
+# Benchmark LLMScheduler against a local mock completion server
+#
+# python benchmarks/bench_llm.py --docs 200 --latency 0.3 --error-rate 0.05
+#
+# The sequential baseline calls the backend once per document, like
+# analyze_posts used to. Every mode must produce identical responses.
+
+MODEL = "meta/llama3-70b-instruct"
+
+
+def make_docs(n):
+    rnd = random.Random(0)
+    return [
+        " ".join(f"word{rnd.randint(0, 5000)}" for _ in range(rnd.randint(100, 2000)))
+        for _ in range(n)
+    ]
+
+
+def call(llm, doc):
+    prompt = {"role": "user", "content": f"Assign 10 tags\n---\n{doc}"}
+    resp = llm(messages=[prompt], model=MODEL, n=1, max_tokens=400)
+    return resp["choices"][0]["message"]["content"]
+
+
+def sequential(client, docs):
+    out = {}
+    for i, doc in enumerate(docs):
+        try:
+            out[i] = call(client, doc)
+        except Exception:
+            pass
+    return out
+
+
+def scheduled(client, docs, concurrency, tokens_per_second):
+    llm = LLMScheduler(
+        client,
+        concurrency=concurrency,
+        tokens_per_second=tokens_per_second,
+        backoff=0.1,
+    )
+    out = {}
+    for i, res, ex in llm.map(lambda i: call(llm, docs[i]), range(len(docs))):
+        if ex is None:
+            out[i] = res
+    return out, llm.retries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--skip-sequential", action="store_true")
+    cfg = parser.parse_args()
+
+    server = start_server(cfg.latency, cfg.error_rate)
+    client = CompletionClient(f"http://127.0.0.1:{server.server_address[1]}")
+    docs = make_docs(cfg.docs)
+    reference = None
+    if not cfg.skip_sequential:
+        t = time.time()
+        reference = sequential(client, docs)
+        t = time.time() - t
+        print(f"{'sequential':<16} {len(docs) / t:8.1f} docs/s ok {len(reference)}")
+    for c in cfg.concurrency:
+        t = time.time()
+        out, retries = scheduled(client, docs, c, cfg.tokens_per_second)
+        t = time.time() - t
+        same = all(out.get(i) == r for i, r in (reference or {}).items())
+        print(
+            f"{f'concurrency={c}':<16} {len(docs) / t:8.1f} docs/s ok {len(out)} "
+            f"retries {retries} identical {same}"
+        )
+    server.shutdown()
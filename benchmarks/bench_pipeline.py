@@ -0,0 +1,438 @@
+import argparse, functools, json, os, random, subprocess, sys, tempfile
+import threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from bench_threads import generate, peak_rss
+from hnmetrics import Metrics
+from mockllm import start_server, CompletionClient
+
+# End-to-end benchmark of the pipeline on a synthetic corpus
+#
+# python benchmarks/bench_pipeline.py --posts 500 --comments 200000 \
+#     --latency 0.05 --dist lognormal
+#
+# Runs the work of each flow's heavy step with the same modules the
+# flows use, against local stand-ins for the web and the LLM backend:
+#
+#   crawl      Fetcher from a local page server into ArchiveWriter parts
+#   comments   thread resolution, CommentStore and Parquet comment shards
+#   posts      streaming archive reader, text extraction and LLMScheduler
+#              requests for tags, then topic normalization
+#   sentiment  comment shards read and rated one request at a time, like
+#              analyze_comments, with --pack-posts as in its packed mode
+#
+# Each stage runs in its own subprocess, so that peak RSS (of the stage
+# process, not its worker pools) is measured separately, and reports
+# docs/s and p50/p99 latency of its main stage metric (see hnmetrics.py).
+# Use --save to write the results as JSON and --compare to diff a run
+# against saved results, e.g. before and after a change.
+#
+# --tokenizer words splits at whitespace instead of loading tiktoken,
+# for machines without the BPE files.
+
+STAGES = ["crawl", "comments", "posts", "sentiment"]
+
+# The stage metric whose latency is reported for each stage
+LATENCY = {
+    "crawl": "download",
+    "comments": "resolve round",
+    "posts": "llm",
+    "sentiment": "llm",
+}
+
+MODEL = "meta/llama3-70b-instruct"
+
+# As in hnposts.py and hnsentiment.py
+TAGS_PROMPT = """Assign 10 tags that best describe the following article. Reply only the tags in the following format:
+1. first tag
+2. second tag
+N. Nth tag"""
+
+SENTIMENT_PROMPT = """In the scale between 0-10 where 0 is the most negative sentiment and 10 is the most positive sentiment,
+rank the following discussion. Reply in this format:
+
+SENTIMENT X
+
+where X is the sentiment rating
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def page(post_id, words):
+    # Every 20th post has the same content as the one before it, so
+    # the archive contains hard links like a real crawl
+    rnd = random.Random(post_id - 1 if post_id % 20 == 0 else post_id)
+    text = " ".join(f"word{rnd.randint(0, 20000)}" for _ in range(words))
+    return (
+        "<html><head><script>var x = 1;</script></head><body>"
+        f"<nav>menu</nav><p>{text}</p><footer>footer</footer></body></html>"
+    ).encode("utf-8")
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        cfg = self.server.cfg
+        time.sleep(max(0, random.gauss(cfg.page_latency, cfg.page_latency / 4)))
+        body = page(int(self.path.strip("/")), cfg.page_words)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PageServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Many concurrent connects would overflow the default backlog of 5
+    request_queue_size = 128
+
+
+def start_page_server(cfg):
+    server = PageServer(("0.0.0.0", 0), PageHandler)
+    server.cfg = cfg
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_llm(cfg):
+    server = start_server(
+        cfg.latency,
+        cfg.error_rate,
+        dist=cfg.dist,
+        token_latency=cfg.token_latency,
+        rps=cfg.rps,
+        tpm=cfg.tpm,
+        max_inflight=cfg.max_inflight,
+        pack_noise=cfg.pack_noise,
+    )
+    return server, CompletionClient(f"http://127.0.0.1:{server.server_address[1]}")
+
+
+def load_tokenizer(name):
+    from hntokens import Tokenizer, load_tokenizer
+
+    if name == "words":
+        return Tokenizer(str.split, " ".join)
+    return load_tokenizer(name)
+
+
+def crawl(cfg, root, metrics):
+    from hnarchive import ArchiveWriter
+    from hnfetch import Fetcher
+
+    server = start_page_server(cfg)
+    port = server.server_address[1]
+    # The server runs in this process, so render the pages up front
+    for i in range(1, cfg.posts + 1):
+        page(i, cfg.page_words)
+    posts = [
+        (i, f"post {i}", 100, f"http://127.0.0.{1 + i % cfg.hosts}:{port}/{i}")
+        for i in range(1, cfg.posts + 1)
+    ]
+    fetcher = Fetcher(
+        concurrency=cfg.fetch_concurrency,
+        per_host_rate=cfg.per_host_rate,
+        per_host_inflight=4,
+        metrics=metrics,
+    )
+    with ArchiveWriter(os.path.join(root, "crawl")) as writer:
+        for (post_id, _, _, _), res, ex in fetcher.fetch_all(posts):
+            if ex is None:
+                with metrics.timer("archive"):
+                    writer.add(str(post_id), res[1])
+    server.shutdown()
+    return len(posts)
+
+
+def comments(cfg, root, metrics):
+    import duckdb
+    from hnthreads import (
+        resolve_threads,
+        thread_rows,
+        post_costs,
+        balance_shards,
+        write_shards,
+        CommentStore,
+    )
+    from hntokens import CHARS_PER_TOKEN
+
+    con = duckdb.connect()
+    con.execute("set memory_limit='1GB'")
+    glob = os.path.join(root, "hn-comments", "*.parquet")
+    posts = range(1, cfg.posts + 1)
+    last = time.perf_counter()
+
+    def on_round(i, mapped):
+        nonlocal last
+        now = time.perf_counter()
+        metrics.observe("resolve round", now - last)
+        last = now
+
+    resolve_threads(con, glob, posts, on_round)
+    with metrics.timer("thread rows"):
+        store = CommentStore.from_batches(thread_rows(con, glob))
+    with metrics.timer("balance"):
+        costs = post_costs(store, posts, cfg.num_input_tokens)
+        shards, _ = balance_shards(costs, cfg.shards)
+    with metrics.timer("pack"):
+        for _ in write_shards(
+            store,
+            shards,
+            lambda i: os.path.join(root, f"comments-{i}.parquet"),
+            max_chars=cfg.num_input_tokens * CHARS_PER_TOKEN,
+            processes=cfg.workers,
+        ):
+            pass
+    return cfg.comments
+
+
+def posts(cfg, root, metrics):
+    from hnarchive import open_stream, iter_documents
+    from hnllm import LLMScheduler
+    from hntext import extract_files
+    from hntokens import input_budget
+    from hntopics import build_topics
+
+    server, client = start_llm(cfg)
+    llm = LLMScheduler(
+        metrics.wrap_llm(client), concurrency=cfg.llm_concurrency, backoff=0.1
+    )
+    tokenizer = load_tokenizer(cfg.tokenizer)
+    budget = input_budget(tokenizer, f"{TAGS_PROMPT}\n---\n", 5000, 8192, 400)
+
+    def analyze(doc):
+        # As in HNSentimentAnalyzePosts.analyze
+        post_id, words, ex = doc
+        if ex is not None:
+            raise ex
+        text, _ = tokenizer.truncate(" ".join(words), budget)
+        prompt = {"role": "user", "content": f"{TAGS_PROMPT}\n---\n{text}"}
+        resp = llm(messages=[prompt], model=MODEL, n=1, max_tokens=400)
+        content = resp["choices"][0]["message"]["content"]
+        return [
+            line.split(".", 1)[1].strip()
+            for line in content.strip().splitlines()
+            if "." in line
+        ]
+
+    tags = {}
+    links = {}
+    parts = sorted(f for f in os.listdir(root) if f.startswith("crawl-"))
+    for part in parts:
+        with open(os.path.join(root, part), "rb") as f:
+
+            def read_docs():
+                for post_id, data, link in iter_documents(open_stream(f)):
+                    if link is None:
+                        yield post_id, data
+                    else:
+                        links[post_id] = link
+
+            docs = extract_files(read_docs(), budget, metrics=metrics)
+            for (post_id, _, _), res, ex in llm.map(analyze, docs):
+                if ex is None:
+                    tags[post_id] = res
+                else:
+                    metrics.fail("analyze", ex)
+    for post_id, link in links.items():
+        if link in tags:
+            tags[post_id] = tags[link]
+    with metrics.timer("topics"):
+        build_topics(tags.items())
+    server.shutdown()
+    return len(tags) + sum(1 for p in links if p not in tags)
+
+
+def sentiment(cfg, root, metrics):
+    from hnpack import PACKED_PROMPT, REPLY_TOKENS, packed_content, parse_packed
+    from hnpack import parse_sentiment, pack_docs, in_sample, agreement
+    from hnshards import CommentShard
+    from hntokens import input_budget
+
+    server, client = start_llm(cfg)
+    llm = metrics.wrap_llm(client)
+    tokenizer = load_tokenizer(cfg.tokenizer)
+    budget = input_budget(
+        tokenizer, f"{SENTIMENT_PROMPT}\n---\n", cfg.num_input_tokens, 8192, 10
+    )
+    pack_posts = max(1, cfg.pack_posts)
+    pack_budget = input_budget(
+        tokenizer, f"{PACKED_PROMPT}\n---\n", 8192, 8192, REPLY_TOKENS * pack_posts
+    )
+
+    def rate(doc):
+        prompt = {"role": "user", "content": f"{SENTIMENT_PROMPT}\n---\n{doc}"}
+        resp = llm(messages=[prompt], model=MODEL, n=1, max_tokens=10)
+        score = parse_sentiment(resp["choices"][0]["message"]["content"])
+        if score is None:
+            raise ValueError("invalid sentiment output")
+        return score
+
+    def rate_packed(docs):
+        # None if the request fails, like the flow, which then rates the
+        # posts one at a time
+        prompt = {"role": "user", "content": packed_content(PACKED_PROMPT, docs)}
+        try:
+            resp = llm(
+                messages=[prompt], model=MODEL, n=1, max_tokens=REPLY_TOKENS * len(docs)
+            )
+        except Exception as ex:
+            metrics.fail("packed", ex)
+            return None
+        return parse_packed(resp["choices"][0]["message"]["content"], len(docs))
+
+    num_docs = 0
+    fallbacks = 0
+    pairs = []
+    paths = sorted(f for f in os.listdir(root) if f.startswith("comments-"))
+    for path in paths:
+        shard = CommentShard(os.path.join(root, path))
+        docs = (
+            (post_id, *tokenizer.truncate(text, budget))
+            for post_id, _, text in shard.items()
+        )
+        # One request at a time, as in HNSentimentAnalyzeComments
+        for batch in pack_docs(docs, pack_posts, cfg.pack_max_tokens, pack_budget):
+            scores = None
+            if len(batch) > 1:
+                scores = rate_packed([doc for _, doc, _ in batch])
+                fallbacks += scores is None
+            for i, (post_id, doc, _) in enumerate(batch):
+                num_docs += 1
+                if scores is not None:
+                    if in_sample(post_id, cfg.pack_sample):
+                        try:
+                            pairs.append((scores[i], rate(doc)))
+                        except Exception as ex:
+                            metrics.fail("agreement", ex)
+                    continue
+                try:
+                    rate(doc)
+                except Exception as ex:
+                    metrics.fail("analyze", ex)
+    server.shutdown()
+    if cfg.pack_posts > 1:
+        NOTES.append(f"{fallbacks} packed requests fell back, {agreement(pairs)}")
+    return num_docs
+
+
+# Lines a stage reports besides its metrics
+NOTES = []
+
+RUNNERS = {"crawl": crawl, "comments": comments, "posts": posts, "sentiment": sentiment}
+
+
+def run_stage(cfg, name, root):
+    metrics = Metrics()
+    t = time.perf_counter()
+    docs = RUNNERS[name](cfg, root, metrics)
+    seconds = time.perf_counter() - t
+    result = {
+        "docs": docs,
+        "seconds": seconds,
+        "peak_rss_mb": peak_rss(),
+        "metrics": metrics.to_dict(),
+        "notes": NOTES,
+    }
+    print(json.dumps(result))
+
+
+def summary(name, result):
+    metrics = Metrics.from_dict(result["metrics"])
+    hist = metrics.stages[LATENCY[name]]
+    # Failed documents; failed requests that were retried are only in
+    # the --verbose table
+    failures = sum(metrics.failures["analyze"].values())
+    return {
+        "docs/s": result["docs"] / result["seconds"],
+        "p50": hist.quantile(0.5),
+        "p99": hist.quantile(0.99),
+        "peak_rss_mb": result["peak_rss_mb"],
+        "failures": failures,
+    }
+
+
+def fmt(value):
+    return "-" if value is None else f"{value:.3g}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=300)
+    parser.add_argument("--comments", type=int, default=100000)
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--hosts", type=int, default=10)
+    parser.add_argument("--page-words", type=int, default=3000)
+    parser.add_argument("--page-latency", type=float, default=0.02)
+    parser.add_argument("--fetch-concurrency", type=int, default=64)
+    parser.add_argument("--per-host-rate", type=float, default=50.0)
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--num-input-tokens", type=int, default=3000)
+    parser.add_argument("--tokenizer", default="cl100k_base")
+    parser.add_argument("--llm-concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--dist", default="lognormal")
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rps", type=float, default=0.0)
+    parser.add_argument("--tpm", type=int, default=0)
+    parser.add_argument("--max-inflight", type=int, default=0)
+    parser.add_argument("--pack-posts", type=int, default=0)
+    parser.add_argument("--pack-max-tokens", type=int, default=500)
+    parser.add_argument("--pack-sample", type=float, default=0.05)
+    parser.add_argument("--pack-noise", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true", help="print all metrics")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with results saved by --save")
+    parser.add_argument("--run-stage", nargs=2, help=argparse.SUPPRESS)
+    cfg = parser.parse_args()
+
+    if cfg.run_stage:
+        run_stage(cfg, *cfg.run_stage)
+        sys.exit(0)
+
+    root = tempfile.mkdtemp("bench_pipeline")
+    generate(os.path.join(root, "hn-comments"), cfg.posts, cfg.comments, 0.0)
+    results = {}
+    print(
+        f"{'stage':<10} {'docs':>8} {'seconds':>8} {'docs/s':>8} {'p50':>8} "
+        f"{'p99':>8} {'peak RSS':>9} {'failed':>6}"
+    )
+    for name in cfg.stages:
+        args = sys.argv[1:] + ["--run-stage", name, root]
+        out = subprocess.check_output([sys.executable, __file__] + args)
+        results[name] = json.loads(out.decode("utf-8").strip().splitlines()[-1])
+        s = summary(name, results[name])
+        print(
+            f"{name:<10} {results[name]['docs']:>8} {results[name]['seconds']:>8.2f} "
+            f"{fmt(s['docs/s']):>8} {fmt(s['p50']):>8} {fmt(s['p99']):>8} "
+            f"{s['peak_rss_mb']:>7.0f}MB {s['failures']:>6}"
+        )
+        for note in results[name]["notes"]:
+            print(f"{'':<10} {note}")
+        if cfg.verbose:
+            print(Metrics.from_dict(results[name]["metrics"]).table())
+    if cfg.save:
+        with open(cfg.save, "w") as f:
+            json.dump(results, f)
+    if cfg.compare:
+        with open(cfg.compare) as f:
+            base = json.load(f)
+        print(f"\nchange against {cfg.compare}")
+        for name in cfg.stages:
+            if name not in base:
+                continue
+            new, old = summary(name, results[name]), summary(name, base[name])
+            changes = []
+            for key in ("docs/s", "p50", "p99", "peak_rss_mb"):
+                if new[key] is not None and old[key]:
+                    changes.append(f"{key} {100 * (new[key] / old[key] - 1):+.1f}%")
+            print(f"{name:<10} {', '.join(changes)}")
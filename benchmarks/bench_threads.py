@@ -0,0 +1,170 @@
+import argparse, os, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# Benchmark comment-to-post thread resolution on a synthetic comment tree
+#
+# python benchmarks/bench_threads.py --posts 20000 --comments 2000000
+#
+# Compares the original time-ordered Python walk of HNSentimentCommentData,
+# which builds a dict of lists of strings, with hnthreads.py, which
+# resolves threads with NumPy arrays and stores comments in a compact
+# CommentStore. Each engine runs in its own
+# subprocess, so that peak RSS can be measured separately. Use
+# --out-of-order to give a fraction of comments a timestamp earlier than
+# their parent's, which the original walk drops. With --workers, also
+# time packing the compact store into --shards Parquet shards with that many
+# processes.
+
+
+def generate(path, posts, comments, out_of_order, seed=0):
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rng = np.random.default_rng(seed)
+    ids = np.arange(posts + 1, posts + comments + 1, dtype=np.int64)
+    # A comment replies to a post 30% of the time, otherwise to an
+    # earlier comment, which yields threads of realistic depth
+    to_post = rng.random(comments) < 0.3
+    to_post[0] = True
+    earlier = (rng.random(comments) * np.arange(comments)).astype(np.int64)
+    parent = np.where(
+        to_post, rng.integers(1, posts + 1, comments), ids[0] + earlier
+    )
+    ts = 1577836800 + ids * 10
+    late = rng.random(comments) < out_of_order
+    ts[late] -= 10 * comments
+    dead = rng.random(comments) < 0.02
+    table = pa.table(
+        {
+            "text": [f"comment text {i}" for i in ids],
+            "by": [f"user{i % 5000}" for i in ids],
+            "id": ids,
+            "parent": parent,
+            "timestamp": pa.array(ts * 1000000, pa.timestamp("us")),
+            "dead": dead,
+            "deleted": np.zeros(comments, dtype=bool),
+        }
+    )
+    os.makedirs(path, exist_ok=True)
+    for i, start in enumerate(range(0, comments, 1000000)):
+        pq.write_table(
+            table.slice(start, 1000000), os.path.join(path, f"part-{i}.parquet")
+        )
+    return list(range(1, posts + 1))
+
+
+def legacy(glob, posts):
+    import duckdb
+
+    BS = 1000
+    res = duckdb.query(
+        f"select text, \"by\", id, parent from '{glob}' where"
+        "(dead is null or dead=false) and "
+        "(deleted is null or deleted=false) "
+        "order by timestamp asc"
+    ).execute()
+    post_comments = {id: [] for id in posts}
+    mapping = {id: id for id in posts}
+    rows = res.fetchmany(BS)
+    while rows:
+        for text, by, id, parent in rows:
+            if parent in mapping:
+                post_comments[mapping[parent]].append(f"<{by}> {text}")
+                mapping[id] = mapping[parent]
+        rows = res.fetchmany(BS)
+    return post_comments
+
+
+def compact(glob, posts):
+    import duckdb
+    from hnthreads import resolve_threads, thread_rows, CommentStore
+
+    con = duckdb.connect()
+    con.execute(f"set memory_limit='{DUCKDB_MEMORY}'")
+    resolve_threads(con, glob, posts)
+    return CommentStore.from_batches(thread_rows(con, glob))
+
+
+# Like in hncomments.py, DuckDB spills to disk beyond this
+DUCKDB_MEMORY = "256MB"
+
+ENGINES = {"legacy": legacy, "compact": compact}
+
+
+def num_mapped(result):
+    if isinstance(result, dict):
+        return sum(len(c) for c in result.values())
+    return len(result.comments)
+
+
+def peak_rss():
+    # VmHWM is per address space, unlike ru_maxrss, which a subprocess
+    # inherits from the benchmark process that generated the data
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+
+def pack(store, posts, shards, workers):
+    from hnthreads import post_costs, balance_shards, write_shards
+    from hntokens import CHARS_PER_TOKEN
+
+    # The default --num-input-tokens of hncomments.py
+    num_input_tokens = 3000
+    os.chdir(tempfile.mkdtemp("bench_threads_pack"))
+    t = time.time()
+    parts, _ = balance_shards(post_costs(store, posts, num_input_tokens), shards)
+    for _ in write_shards(
+        store,
+        parts,
+        lambda i: f"comments-{i}.parquet",
+        max_chars=num_input_tokens * CHARS_PER_TOKEN,
+        processes=workers,
+    ):
+        pass
+    return time.time() - t
+
+
+def run_one(name, root, posts, shards, workers):
+    t = time.time()
+    result = ENGINES[name](f"{root}/*.parquet", range(1, posts + 1))
+    t = time.time() - t
+    mapped = num_mapped(result)
+    rss = peak_rss()
+    packed = 0
+    if workers and name == "compact":
+        packed = pack(result, range(1, posts + 1), shards, workers)
+    print(f"{t} {mapped} {rss} {packed}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--comments", type=int, default=2000000)
+    parser.add_argument("--out-of-order", type=float, default=0.0)
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES))
+    parser.add_argument("--shards", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--run-one", nargs=2, help=argparse.SUPPRESS)
+    cfg = parser.parse_args()
+
+    if cfg.run_one:
+        run_one(cfg.run_one[0], cfg.run_one[1], cfg.posts, cfg.shards, cfg.workers)
+        sys.exit(0)
+
+    root = tempfile.mkdtemp("bench_threads")
+    generate(root, cfg.posts, cfg.comments, cfg.out_of_order)
+    for name in cfg.engines:
+        args = ["--posts", str(cfg.posts), "--shards", str(cfg.shards)]
+        args += ["--workers", str(cfg.workers), "--run-one", name, root]
+        out = subprocess.check_output([sys.executable, __file__] + args)
+        t, mapped, rss, packed = out.split()
+        print(
+            f"{name:<8} {cfg.comments / float(t):12.0f} rows/s {float(t):7.1f}s "
+            f"mapped {int(mapped)} peak RSS {float(rss):8.0f}MB"
+        )
+        if float(packed):
+            print(f"{'':<8} packed {cfg.shards} shards with {cfg.workers} workers in {float(packed):.1f}s")
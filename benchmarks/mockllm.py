@@ -0,0 +1,297 @@
+import argparse, hashlib, json, math, random, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for an OpenAI-compatible chat completion backend
+#
+# python benchmarks/mockllm.py --port 8000 --latency 0.5 --dist lognormal \
+#     --rps 20 --tpm 600000 --max-inflight 16
+#
+# Responses are a deterministic function of the prompt, so results
+# of different client implementations can be compared exactly. Prompts
+# asking for a SENTIMENT rating get "SENTIMENT X", all others a numbered
+# list of 10 tags drawn from a small topic vocabulary, written in the
+# varying forms LLMs use ("GPUs", "gpu", "Machine-learning"). Packed
+# sentiment prompts (see hnpack.py) get a "POST n: SENTIMENT X" line per
+# section, with the rating the section would get alone; --pack-noise
+# is the probability that a line is off by one or missing.
+#
+# Latencies follow --dist with mean --latency, plus --token-latency
+# seconds per 1000 prompt tokens. Requests beyond --rps requests per
+# second, --tpm prompt tokens per minute or --max-inflight concurrent
+# requests are rejected with 429 and a Retry-After header, like a
+# rate-limited hosted backend. --error-rate adds random 429/503s.
+
+TOPICS = [
+    "Machine learning",
+    "Large language models",
+    "Rust",
+    "Python",
+    "JavaScript",
+    "Startups",
+    "Venture capital",
+    "Privacy",
+    "Open source",
+    "Databases",
+    "Security",
+    "GPU",
+    "Remote work",
+    "Kubernetes",
+    "Climate change",
+    "Space exploration",
+    "Hardware",
+    "Web development",
+    "Programming languages",
+    "Apple",
+    "Google",
+    "Regulation",
+    "Education",
+    "Productivity",
+    "Cryptocurrency",
+]
+
+
+def _variant(rnd, topic):
+    # The surface forms seen in real responses
+    form = rnd.random()
+    if form < 0.1:
+        return topic.lower()
+    if form < 0.15:
+        return topic.replace(" ", "-")
+    if form < 0.2 and not topic.endswith("s"):
+        return topic + "s"
+    return topic
+
+
+def rating(doc):
+    digest = hashlib.sha1(doc.strip().encode("utf-8")).hexdigest()
+    return int(digest, 16) % 11
+
+
+def packed_reply(body, noise):
+    lines = []
+    sections = re.split(r"^### POST (\d+)\n", body, flags=re.M)
+    for label, doc in zip(sections[1::2], sections[2::2]):
+        score = rating(doc)
+        if random.random() < noise:
+            if random.random() < 0.5:
+                continue
+            score = min(10, max(0, score + random.choice([-1, 1])))
+        lines.append(f"POST {label}: SENTIMENT {score}")
+    return "\n".join(lines)
+
+
+def mock_content(prompt, noise=0.0):
+    if "SENTIMENT" in prompt:
+        # Rate the document after the instructions, like a model would
+        _, _, body = prompt.partition("\n---\n")
+        if re.match(r"### POST \d+\n", body):
+            return packed_reply(body, noise)
+        return f"SENTIMENT {rating(body)}"
+    digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+    rnd = random.Random(digest)
+    tags = rnd.sample(TOPICS, 10)
+    return "\n".join(f"{i + 1}. {_variant(rnd, tag)}" for i, tag in enumerate(tags))
+
+
+def sample_latency(cfg, prompt_tokens):
+    mean = cfg.latency
+    if cfg.dist == "fixed":
+        latency = mean
+    elif cfg.dist == "exponential":
+        latency = random.expovariate(1 / mean) if mean > 0 else 0.0
+    elif cfg.dist == "lognormal":
+        # mu chosen so that the mean is `latency`, with a heavy tail
+        sigma = cfg.sigma
+        latency = random.lognormvariate(math.log(max(mean, 1e-9)) - sigma**2 / 2, sigma)
+    else:
+        latency = random.gauss(mean, mean / 4)
+    return max(0.0, latency) + cfg.token_latency * prompt_tokens / 1000
+
+
+class Limit:
+    """Token bucket that rejects instead of waiting. Requests larger than
+    the bucket are let through once it is full."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def take(self, n):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= min(n, self.rate):
+            self.tokens -= n
+            return 0.0
+        return (min(n, self.rate) - self.tokens) / self.rate
+
+
+class CompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, which Nagle's algorithm
+    # would delay by up to 40ms on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        cfg = self.server.cfg
+        req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = req["messages"][-1]["content"]
+        prompt_tokens = len(prompt) // 4
+        retry_after = self.server.admit(prompt_tokens)
+        if retry_after is not None:
+            return self.reply(429, {}, {"Retry-After": f"{retry_after:.3f}"})
+        try:
+            if random.random() < cfg.error_rate:
+                self.server.count("errors")
+                return self.reply(429 if random.random() < 0.5 else 503, {})
+            time.sleep(sample_latency(cfg, prompt_tokens))
+            self.server.count("ok")
+            self.complete(prompt, prompt_tokens)
+        finally:
+            self.server.release()
+
+    def complete(self, prompt, prompt_tokens):
+        content = mock_content(prompt, self.server.cfg.pack_noise)
+        completion_tokens = max(1, len(content) // 4)
+        self.reply(
+            200,
+            {
+                "choices": [{"message": {"role": "assistant", "content": content}}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+        )
+
+    def reply(self, code, obj, headers=None):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CompletionServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, cfg):
+        super().__init__(address, CompletionHandler)
+        self.cfg = cfg
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.requests = Limit(cfg.rps) if cfg.rps > 0 else None
+        self.tokens = Limit(cfg.tpm / 60) if cfg.tpm > 0 else None
+        self.stats = {"ok": 0, "errors": 0, "rate_limited": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def admit(self, prompt_tokens):
+        """Return None if the request may proceed, otherwise the seconds
+        after which it may be retried."""
+        with self.lock:
+            wait = None
+            if self.cfg.max_inflight and self.inflight >= self.cfg.max_inflight:
+                wait = self.cfg.latency
+            elif self.requests and (w := self.requests.take(1)):
+                wait = w
+            elif self.tokens and (w := self.tokens.take(prompt_tokens)):
+                wait = w
+            if wait is None:
+                self.inflight += 1
+            else:
+                self.stats["rate_limited"] += 1
+            return wait
+
+    def release(self):
+        with self.lock:
+            self.inflight -= 1
+
+
+def start_server(
+    latency=0.5,
+    error_rate=0.0,
+    port=0,
+    dist="normal",
+    sigma=0.5,
+    token_latency=0.0,
+    rps=0.0,
+    tpm=0,
+    max_inflight=0,
+    pack_noise=0.0,
+):
+    cfg = argparse.Namespace(
+        latency=latency,
+        error_rate=error_rate,
+        dist=dist,
+        sigma=sigma,
+        token_latency=token_latency,
+        rps=rps,
+        tpm=tpm,
+        max_inflight=max_inflight,
+        pack_noise=pack_noise,
+    )
+    server = CompletionServer(("127.0.0.1", port), cfg)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class CompletionClient:
+    """Callable with the same interface as current.nim.models[MODEL]."""
+
+    def __init__(self, base_url):
+        import requests
+
+        self.url = f"{base_url}/v1/chat/completions"
+        self.local = threading.local()
+        self.requests = requests
+
+    def __call__(self, messages, model=None, **kwargs):
+        sess = getattr(self.local, "session", None)
+        if sess is None:
+            sess = self.local.session = self.requests.Session()
+        resp = sess.post(self.url, json=dict(messages=messages, model=model, **kwargs))
+        resp.raise_for_status()
+        return resp.json()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--dist", choices=["normal", "lognormal", "exponential", "fixed"], default="normal"
+    )
+    parser.add_argument("--sigma", type=float, default=0.5, help="lognormal shape")
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--rps", type=float, default=0.0)
+    parser.add_argument("--tpm", type=int, default=0)
+    parser.add_argument("--max-inflight", type=int, default=0)
+    parser.add_argument("--pack-noise", type=float, default=0.0)
+    cfg = parser.parse_args()
+    server = start_server(
+        cfg.latency,
+        cfg.error_rate,
+        cfg.port,
+        cfg.dist,
+        cfg.sigma,
+        cfg.token_latency,
+        cfg.rps,
+        cfg.tpm,
+        cfg.max_inflight,
+        cfg.pack_noise,
+    )
+    print(f"serving on http://127.0.0.1:{server.server_address[1]}")
+    threading.Event().wait()
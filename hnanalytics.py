@@ -0,0 +1,204 @@
+import os
+
+# Analytics store for the notebooks
+#
+# build_store() joins the stories, the normalized post topics (see
+# hntopics.py) and the post sentiments once into three Parquet tables:
+#
+#   posts        post_id, time, title, url, sentiment, comment_tokens
+#                one row per story, sorted by post_id; sentiment is null
+#                for posts that weren't analyzed
+#   post_topics  post_id, topic_id
+#                sorted by topic_id, so it doubles as an inverted index
+#                from topics to posts
+#   topics       topic_id, topic
+#                the topic vocabulary
+#
+# Queries aggregate over integer topic ids and look up labels last.
+# Analytics loads the tables into an in-memory DuckDB database and
+# exposes the analyses of sentiments.ipynb and top-topics.ipynb as SQL
+# queries returning pandas DataFrames. Per-topic sentiment statistics
+# are computed by TopicStats in hnstats.py.
+#
+# DuckDB is imported in functions, as the notebooks are its only users.
+
+SINCE = "2020-01-01"
+
+
+def build_store(
+    root, post_topics, labels, sentiment_path, stories="story.parquet", since=SINCE
+):
+    """Materialize the store in the directory root. post_topics are the
+    (post_ids, offsets, topic_ids) arrays and labels the vocabulary of
+    hntopics.build_topics, sentiment_path a local result table (see
+    hnresults.py)."""
+    import duckdb  # pylint: disable=import-error
+    import numpy as np  # pylint: disable=import-error
+    import pyarrow as pa  # pylint: disable=import-error
+
+    os.makedirs(root, exist_ok=True)
+    con = duckdb.connect()
+    con.execute(
+        f"""
+        copy (
+            select s.id as post_id, s.time, s.title, s.url,
+                   r.sentiment, r.num_tokens as comment_tokens
+            from '{stories}' s left join '{sentiment_path}' r on r.post_id = s.id
+            where to_timestamp(s.time) > timestamp '{since}'
+            order by s.id
+        ) to '{root}/posts.parquet' (format parquet, compression zstd)
+        """
+    )
+    post_ids, offsets, topic_ids = post_topics
+    pairs = pa.table(
+        {
+            "post_id": np.repeat(post_ids, np.diff(offsets)),
+            "topic_id": topic_ids,
+        }
+    )
+    topics = pa.table(
+        {"topic_id": np.arange(len(labels), dtype=np.int32), "topic": labels}
+    )
+    con.register("pairs", pairs)
+    con.register("vocab", topics)
+    con.execute(
+        f"""
+        copy (select * from pairs order by topic_id, post_id)
+        to '{root}/post_topics.parquet' (format parquet, compression zstd)
+        """
+    )
+    con.execute(
+        f"copy vocab to '{root}/topics.parquet' (format parquet, compression zstd)"
+    )
+
+
+class Analytics:
+    def __init__(self, root):
+        import duckdb  # pylint: disable=import-error
+
+        self.con = duckdb.connect()
+        for table in ("posts", "post_topics", "topics"):
+            self.con.execute(
+                f"create table {table} as select * from '{root}/{table}.parquet'"
+            )
+
+    def query(self, sql, *params):
+        return self.con.execute(sql, list(params)).df()
+
+    def topic_counts(self, first=None, last=None, limit=None):
+        """Number of posts per topic, for posts with first <= time < last
+        (epoch seconds, None = unbounded)."""
+        return self.query(
+            f"""
+            select topic, posts from (
+                select topic_id, count(*) as posts
+                from post_topics join posts using (post_id)
+                where ($1 is null or time >= $1) and ($2 is null or time < $2)
+                group by topic_id
+            ) join topics using (topic_id)
+            order by posts desc, topic
+            {f"limit {int(limit)}" if limit else ""}
+            """,
+            first,
+            last,
+        )
+
+    def topic_diff(self, cutoff, min_posts=100):
+        """Change in the share of posts about each topic before and after
+        cutoff, old share minus new share, for topics with at least
+        min_posts posts. Topics seen only on one side have a zero count
+        on the other."""
+        return self.query(
+            """
+            with sizes as (
+                select count(*) filter (where time < $1) as old_total,
+                       count(*) filter (where time >= $1) as new_total
+                from posts
+            ), counts as (
+                select topic_id,
+                       count(*) filter (where time < $1) as old_posts,
+                       count(*) filter (where time >= $1) as new_posts
+                from post_topics join posts using (post_id)
+                group by topic_id
+            )
+            select topic, old_posts, new_posts,
+                   old_posts / old_total - new_posts / new_total as diff
+            from counts join topics using (topic_id), sizes
+            where old_posts + new_posts >= $2
+            order by diff, topic
+            """,
+            cutoff,
+            min_posts,
+        )
+
+    def topic_timeseries(self, topics, last=None):
+        """Monthly number of posts about each of topics, for posts before
+        last (epoch seconds)."""
+        return self.query(
+            """
+            select topic, date, posts from (
+                select topic_id, date_trunc('month', to_timestamp(time)) as date,
+                       count(*) as posts
+                from post_topics join posts using (post_id)
+                where topic_id in (select topic_id from topics
+                                   where topic in (select unnest($1)))
+                      and ($2 is null or time < $2)
+                group by topic_id, date
+            ) join topics using (topic_id)
+            order by topic, date
+            """,
+            list(topics),
+            last,
+        )
+
+    def daily_mood(self, last=None):
+        """Mean sentiment of posts per day, for posts before last."""
+        return self.query(
+            """
+            select date_trunc('day', to_timestamp(time)) as date,
+                   avg(sentiment) as mood
+            from posts
+            where sentiment is not null and ($1 is null or time < $1)
+            group by date order by date
+            """,
+            last,
+        )
+
+    def sentiment_histogram(self):
+        return self.query(
+            """
+            select sentiment as score, count(*) as count from posts
+            where sentiment is not null group by score order by score
+            """
+        )
+
+    def topic_posts(self, topic=None, min_comment_tokens=0):
+        """Posts about topic (None = all topics) with a sentiment and more
+        than min_comment_tokens tokens of comments, sorted by topic and
+        sentiment."""
+        return self.query(
+            """
+            select topic, post_id, sentiment, time, title, url
+            from post_topics join posts using (post_id) join topics using (topic_id)
+            where ($1 is null or topic = $1) and sentiment is not null
+                  and comment_tokens > $2
+            order by topic, sentiment, post_id
+            """,
+            topic,
+            min_comment_tokens,
+        )
+
+
+def store_from_runs(root, posts_run, sentiment_run, stories="story.parquet"):
+    """Return Analytics over the results of the given HNSentimentAnalyzePosts
+    and HNSentimentAnalyzeComments runs, building the store in root unless
+    it exists already."""
+    from hnresults import load_results
+
+    if not os.path.exists(os.path.join(root, "topics.parquet")):
+        end = posts_run["end"].task
+        sentiment = load_results(sentiment_run["end"].task["post_sentiment_url"].data)
+        build_store(
+            root, end["post_topics"].data, end["topic_vocab"].data, sentiment.path, stories
+        )
+    return Analytics(root)
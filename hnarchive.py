@@ -0,0 +1,241 @@
+import contextlib, gzip, hashlib, io, os, posixpath, tarfile, tempfile, threading, time
+
+# Streaming tar archives for crawl and comment data
+#
+# ArchiveWriter appends documents to a tar stream as they arrive instead
+# of staging them in a temp directory first. When the compressed archive
+# grows past max_bytes, it is closed and handed to on_part (typically an
+# S3 upload running in the background) and a new part is started, so
+# disk usage stays bounded by roughly one part.
+#
+# On the reading side, open_stream() and iter_documents() read an archive
+# sequentially from any file-like object, such as an S3 response body
+# (see open_url), so documents can be processed while the archive is
+# still downloading, without extracting it to disk first.
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+EXTENSIONS = {"gz": "tar.gz", "zst": "tar.zst"}
+
+
+class ArchiveWriter:
+    def __init__(
+        self,
+        prefix,
+        compression="gz",
+        level=6,
+        max_bytes=0,
+        on_part=None,
+        root="data",
+    ):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown compression {compression}")
+        self.prefix = prefix
+        self.compression = compression
+        self.level = level
+        self.max_bytes = max_bytes
+        self.on_part = on_part
+        self.root = root
+        self.parts = []
+        self.tar = None
+
+    def _open(self):
+        path = f"{self.prefix}-{len(self.parts)}.{EXTENSIONS[self.compression]}"
+        self.raw = open(path, "wb")
+        if self.compression == "zst":
+            import zstandard  # pylint: disable=import-error
+
+            cctx = zstandard.ZstdCompressor(level=self.level)
+            self.stream = cctx.stream_writer(self.raw, closefd=False)
+        else:
+            self.stream = gzip.GzipFile(
+                fileobj=self.raw, mode="wb", compresslevel=self.level, mtime=0
+            )
+        self.tar = tarfile.open(fileobj=self.stream, mode="w|")
+        self.parts.append(path)
+        # content hash -> member name, for hard links within this part
+        self.digests = {}
+
+    def _close(self):
+        self.tar.close()
+        self.stream.close()
+        self.raw.close()
+        self.tar = None
+        if self.on_part:
+            self.on_part(self.parts[-1])
+
+    def add(self, name, data):
+        """Add a document. Identical content within a part is stored once
+        and linked to from later names."""
+        if self.tar is None:
+            self._open()
+        arcname = f"{self.root}/{name}"
+        digest = hashlib.sha1(data).digest()
+        info = tarfile.TarInfo(name=arcname)
+        info.mtime = int(time.time())
+        if digest in self.digests:
+            info.type = tarfile.LNKTYPE
+            info.linkname = self.digests[digest]
+            self.tar.addfile(info)
+        else:
+            info.size = len(data)
+            self.tar.addfile(info, io.BytesIO(data))
+            self.digests[digest] = arcname
+        if self.max_bytes and self.raw.tell() >= self.max_bytes:
+            self._close()
+
+    def close(self):
+        if self.tar is not None:
+            self._close()
+        return self.parts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_archive(path):
+    """Open a tar archive written by ArchiveWriter or plain tarfile.
+    zstd archives can only be read sequentially."""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == ZSTD_MAGIC:
+        import zstandard  # pylint: disable=import-error
+
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        return tarfile.open(fileobj=stream, mode="r|")
+    return tarfile.open(path)
+
+
+class _Prefixed:
+    # A stream whose first bytes were already read to detect its format
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.head = self.head + self.stream.read(), b""
+            return data
+        data, self.head = self.head[:size], self.head[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+
+def open_stream(stream):
+    """Open a tar archive (plain, gzip or zstd) for sequential reading
+    from a file-like object that need not be seekable."""
+    head = stream.read(len(ZSTD_MAGIC))
+    stream = _Prefixed(head, stream)
+    if head == ZSTD_MAGIC:
+        import zstandard  # pylint: disable=import-error
+
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+        return tarfile.open(fileobj=stream, mode="r|")
+    return tarfile.open(fileobj=stream, mode="r|*")
+
+
+def iter_documents(tar):
+    """Yield (name, data, link) for the documents of a tar archive opened
+    for sequential reading, in archive order, with the directory part of
+    names removed. For hard links, as written by ArchiveWriter for
+    duplicate content, data is None and link is the name of the earlier
+    document they point to; otherwise link is None."""
+    for info in tar:
+        name = posixpath.basename(info.name)
+        if info.islnk():
+            yield name, None, posixpath.basename(info.linkname)
+        elif info.isfile():
+            yield name, tar.extractfile(info).read(), None
+
+
+class _Download:
+    # Copies a stream to a local file in a background thread, while
+    # read() follows the file as it grows. The download runs at full
+    # speed even while the reader is slow, so the connection never idles.
+    def __init__(self, stream, path, chunk_size=1024**2):
+        self.cond = threading.Condition()
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.file = open(path, "rb")
+        self.thread = threading.Thread(
+            target=self._copy, args=(stream, path, chunk_size), daemon=True
+        )
+        self.thread.start()
+
+    def _copy(self, stream, path, chunk_size):
+        try:
+            with open(path, "ab") as out:
+                while True:
+                    data = stream.read(chunk_size)
+                    if not data:
+                        break
+                    out.write(data)
+                    out.flush()
+                    with self.cond:
+                        self.size += len(data)
+                        self.cond.notify_all()
+        except Exception as ex:
+            self.error = ex
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def read(self, size=-1):
+        with self.cond:
+            if size is None or size < 0:
+                self.cond.wait_for(lambda: self.done)
+            else:
+                self.cond.wait_for(
+                    lambda: self.done or self.size - self.file.tell() >= size
+                )
+            if self.error is not None:
+                raise self.error
+        return self.file.read(size)
+
+    def close(self):
+        self.thread.join()
+        self.file.close()
+
+
+@contextlib.contextmanager
+def open_url(url):
+    """Open the S3 object at url for reading. With boto3, reading can
+    start as soon as the download does; otherwise the object is
+    downloaded with metaflow.S3 first. Either way it is stored in a
+    temporary file, which is removed on exit."""
+    try:
+        import boto3  # pylint: disable=import-error
+    except ImportError:
+        boto3 = None
+    if boto3 is None:
+        from metaflow import S3
+
+        with S3() as s3, open(s3.get(url).path, "rb") as f:
+            yield f
+        return
+    from urllib.parse import urlparse
+
+    try:
+        from metaflow.metaflow_config import S3_ENDPOINT_URL
+    except ImportError:
+        S3_ENDPOINT_URL = None
+    parsed = urlparse(url)
+    client = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL)
+    body = client.get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip("/"))["Body"]
+    fd, path = tempfile.mkstemp("hnarchive")
+    os.close(fd)
+    download = _Download(body, path)
+    try:
+        yield download
+    finally:
+        body.close()
+        download.close()
+        os.remove(path)
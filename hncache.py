@@ -0,0 +1,107 @@
+import gzip, hashlib, json, threading
+
+# Content-addressed cache of LLM responses
+#
+# Responses are keyed by a hash of everything that determines them:
+# model, messages (prompt and truncated document) and sampling arguments
+# such as max_tokens. Each analysis task saves the entries it added as a
+# gzipped JSON-lines shard, and the flows pass the list of shards on from
+# run to run, so reruns only pay for documents or prompts that changed.
+
+
+def cache_key(messages, **kwargs):
+    data = json.dumps([messages, kwargs], sort_keys=True).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+class ResponseCache:
+    def __init__(self):
+        self.entries = {}
+        self.added = {}
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                key, content = json.loads(line)
+                self.entries[key] = content
+
+    def save(self, path, everything=False):
+        """Write entries added since loading (or all entries) to path.
+        Returns the number of entries written."""
+        entries = self.entries if everything else self.added
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            for item in entries.items():
+                f.write(json.dumps(item) + "\n")
+        return len(entries)
+
+    def wrap(self, llm):
+        """Return a callable with the same interface as llm that serves
+        repeated requests from the cache."""
+
+        def cached(messages, **kwargs):
+            key = cache_key(messages, **kwargs)
+            with self.lock:
+                content = self.entries.get(key)
+                if content is not None:
+                    self.hits += 1
+                    return {"choices": [{"message": {"content": content}}]}
+                self.misses += 1
+            resp = llm(messages=messages, **kwargs)
+            content = resp["choices"][0]["message"]["content"]
+            with self.lock:
+                self.entries[key] = self.added[key] = content
+            return resp
+
+        return cached
+
+    def summary(self):
+        return f"LLM cache hits {self.hits}, misses {self.misses}"
+
+
+def previous_cache_shards(flow_name):
+    from metaflow import Flow
+
+    try:
+        return Flow(flow_name).latest_successful_run.data.cache_shards
+    except:
+        return []
+
+
+def load_cache(shards):
+    from metaflow import S3
+
+    cache = ResponseCache()
+    if shards:
+        with S3() as s3:
+            for obj in s3.get_many(shards):
+                cache.load(obj.path)
+        print(f"Loaded {len(cache)} cached LLM responses")
+    return cache
+
+
+def save_cache(cache, run, name):
+    # Upload the entries added by this task, returning the shard url
+    from metaflow import S3
+
+    if cache.save(name):
+        with S3(run=run) as s3:
+            [(_, url)] = s3.put_files([(f"llm-cache/{name}", name)])
+            return url
+
+
+def compact_shards(shards, run, max_shards=200):
+    # Merge shards into one when too many have accumulated over runs
+    from metaflow import S3
+
+    if len(shards) <= max_shards:
+        return shards
+    cache = load_cache(shards)
+    cache.save("compacted.jsonl.gz", everything=True)
+    with S3(run=run) as s3:
+        [(_, url)] = s3.put_files([("llm-cache/compacted.jsonl.gz", "compacted.jsonl.gz")])
+    return [url]
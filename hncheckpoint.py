@@ -0,0 +1,54 @@
+import gzip, pickle, time
+
+# Periodic checkpoints for long-running foreach tasks
+#
+# A task saves its partial results to S3 under a key derived from the
+# step name and foreach index, at most every `interval` seconds. When
+# @retry restarts the task, load() returns the latest checkpoint, so the
+# task can skip the documents it already completed. Failed documents
+# aren't part of the results, so they are retried.
+
+
+class Checkpoint:
+    def __init__(self, run, name, interval=300):
+        self.run = run
+        self.key = f"checkpoints/{name}.pkl.gz"
+        self.interval = interval
+        self.started = self.last = time.time()
+        self.saves = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def load(self):
+        from metaflow import S3
+
+        with S3(run=self.run) as s3:
+            obj = s3.get(self.key, return_missing=True)
+            if obj.exists:
+                with open(obj.path, "rb") as f:
+                    return pickle.loads(gzip.decompress(f.read()))
+
+    def save(self, state):
+        from metaflow import S3
+
+        t = time.time()
+        data = gzip.compress(pickle.dumps(state), compresslevel=1)
+        with S3(run=self.run) as s3:
+            s3.put(self.key, data)
+        self.last = time.time()
+        self.saves += 1
+        self.seconds += self.last - t
+        self.bytes += len(data)
+
+    def maybe_save(self, state_fn):
+        # state_fn is called only when a checkpoint is due
+        if self.interval > 0 and time.time() - self.last >= self.interval:
+            self.save(state_fn())
+
+    def summary(self):
+        elapsed = max(1e-9, time.time() - self.started)
+        return (
+            f"{self.saves} checkpoints saved in {self.seconds:.1f}s "
+            f"({100 * self.seconds / elapsed:.2f}% of task time), "
+            f"{self.bytes / 1024**2:.1f}MB in total"
+        )
@@ -12,10 +12,21 @@ from metaflow import (
     S3,
     resources,
 )
-from metaflow.cards import Markdown, ProgressBar
-import math, tarfile, shutil
-import tempfile, os, time, io
-import html
+from metaflow.cards import Markdown
+import os, time
+
+from hnthreads import (
+    resolve_threads,
+    thread_rows,
+    post_costs,
+    balance_shards,
+    write_shards,
+    CommentStore,
+)
+from hnshards import skew
+from hnmetrics import Metrics, CardStatus
+from hnstories import iter_posts
+from hntokens import CHARS_PER_TOKEN
 
 # Flow 4
 # Produce comments threads for HN posts of interest
@@ -55,19 +66,33 @@ import html
 # After this, open hnsentiment.py
 
 
+# DuckDB spills to disk beyond this, leaving room for the comment store
+DUCKDB_MEMORY = "6GB"
+
+
 @project(name="hn_sentiment")
 class HNSentimentCommentData(FlowSpec):
 
     local_parquets = Parameter("local-parquets", default="hn-comments")
     local_mode = Parameter("local-mode", default=False, is_flag=True)
     num_shards = Parameter("num-shards", default=50)
+    shard_workers = Parameter(
+        "shard-workers",
+        default=8,
+        help="Processes packing comment shards in parallel",
+    )
+    num_input_tokens = Parameter(
+        "num-input-tokens",
+        default=3000,
+        help="Max model tokens per discussion in hnsentiment.py, to pack and balance shards",
+    )
 
+    @conda(packages={"pyarrow": "16.1.0"})
     @step
     def start(self):
         if not self.local_mode:
             self.comment_parquets = self.ensure_parquets()
-        posts = Flow("HNSentimentInit").latest_successful_run.data.posts
-        self.posts = {id for id, _, _, _ in posts}
+        self.posts = {post_id for post_id, in iter_posts([])}
         self.next(self.construct_comments)
 
     def ensure_parquets(self):
@@ -100,92 +125,94 @@ class HNSentimentCommentData(FlowSpec):
                     )
                 return root
 
-    @conda(packages={"duckdb": "1.0.0"})
-    @resources(disk=10000, cpu=8, memory=32000)
+    @conda(packages={"duckdb": "1.0.0", "numpy": "1.26.4", "pyarrow": "16.1.0"})
+    @resources(disk=10000, cpu=8, memory=16000)
     @card(type="blank")
     @retry
     @step
     def construct_comments(self):
-        self.parquet_root = self.ensure_local()
+        metrics = Metrics()
+        with metrics.timer("download"):
+            self.parquet_root = self.ensure_local()
         print(f"{len(os.listdir(self.parquet_root))} parquet files loaded")
-        post_comments = self.construct()
+        store = self.construct(metrics)
+        with metrics.timer("balance"):
+            costs = post_costs(store, self.posts, self.num_input_tokens)
+            shards, self.shard_costs = balance_shards(costs, self.num_shards)
+        self.report_shards(costs)
         self.post_comments_meta = {}
-        current.card.append(Markdown("Packaging tarballs"))
-        current.card.refresh()
-        shards = []
-        files = []
-        for i in range(self.num_shards):
-            tarname = f"comments-{i}.tar.gz"
-            shards.append(tarfile.open(tarname, mode="w:gz"))
-            files.append((f"comments/{tarname}", tarname))
-        for post_id, comments in post_comments.items():
-            s = post_id % self.num_shards
-            self.post_comments_meta[post_id] = (len(comments), files[s])
-            data = html.unescape("\n".join(comments)).encode("utf-8")
-            buf = io.BytesIO(data)
-            tarinfo = tarfile.TarInfo(name=f"comments/{post_id}")
-            tarinfo.size = len(data)
-            buf.seek(0)
-            shards[s].addfile(tarinfo, buf)
-        for shard in shards:
-            shard.close()
-        with S3(run=self) as s3:
-            self.tarballs = [url for _, url in s3.put_files(files)]
-            print(f"uploaded {len(self.tarballs)} tarballs")
+        status = CardStatus(
+            "# Packaging shards",
+            total=self.num_shards,
+            label="Shards packed",
+            metrics=metrics,
+        )
+        files = [None] * self.num_shards
+        started = time.perf_counter()
+        done = write_shards(
+            store,
+            shards,
+            lambda i: f"comments-{i}.parquet",
+            max_chars=self.num_input_tokens * CHARS_PER_TOKEN,
+            processes=self.shard_workers,
+        )
+        for num_done, (i, fname, meta) in enumerate(done, 1):
+            files[i] = (f"comments/{fname}", fname)
+            for post_id, (num_comments, row_group) in meta.items():
+                self.post_comments_meta[post_id] = (num_comments, files[i], row_group)
+            status.update(done=num_done)
+        metrics.observe("pack", time.perf_counter() - started)
+        status.update(force=True)
+        with metrics.timer("upload"), S3(run=self) as s3:
+            self.shards = [url for _, url in s3.put_files(files)]
+            print(f"uploaded {len(self.shards)} shards")
+        print(metrics.table())
+        self.metrics = metrics.to_dict()
         self.next(self.end)
 
-    def construct(self):
-        BS = 1000
+    def report_shards(self, costs):
+        # Compare against the skew that hashing by post id would have
+        modulo = [0] * self.num_shards
+        for post_id, cost in costs.items():
+            modulo[post_id % self.num_shards] += cost
+        mean = sum(self.shard_costs) / max(1, self.num_shards)
+        summary = (
+            f"# Estimated tokens per shard\n\nmax {max(self.shard_costs, default=0)}, "
+            f"mean {mean:.0f}, skew {skew(self.shard_costs):.2f} "
+            f"(hashing by post id: {skew(modulo):.2f})"
+        )
+        print(summary)
+        current.card.append(Markdown(summary))
+
+    def construct(self, metrics):
         import duckdb  # pylint: disable=import-error
 
-        num_rows = (
-            duckdb.query(f"select count(*) from '{self.parquet_root}/*.parquet'")
-            .execute()
-            .fetchone()
-        )
-        status = Markdown(f"# Starting to process: {num_rows} comments in the DB")
-        progress = ProgressBar(max=num_rows, label="Comments processed")
-        current.card.append(status)
-        current.card.append(progress)
-        current.card.refresh()
-
-        # BigQuery Hacker News table has an annoying format: Comments don't have
-        # a direct reference to their post, just to their immediate parent which
-        # may be a post or another comment. Hence we must link deep comments back
-        # to their parent post recursively.
-        #
-        # We do this by going through all comments starting with the oldest
-        # comments. As we encounter comments, we create a mapping on the fly that
-        # map comments to the original post through their parents. This is
-        # based on the assumption that parent comments always precede child comments
-        # in time-ordered traversal.
-        #
-        # The end result is a flattened list of comments per post, returned in
-        # post_comments.
-
-        res = duckdb.query(
-            f"select text, by, id, parent from '{self.parquet_root}/*.parquet' where"
-            "(dead is null or dead=false) and "
-            "(deleted is null or deleted=false) "
-            "order by timestamp asc"
-        ).execute()
-        post_comments = {id: [] for id in self.posts}
-        mapping = {id: id for id in self.posts}
-        mapped = 0
-        rows = res.fetchmany(BS)
-        row_count = 0
-        while rows:
-            for text, by, id, parent in rows:
-                if parent in mapping:
-                    post_comments[mapping[parent]].append(f"<{by}> {text}")
-                    mapping[id] = mapping[parent]
-                    mapped += 1
-            row_count += len(rows)
-            status.update(f"## Mapped {mapped} comments")
-            progress.update(row_count)
-            current.card.refresh()
-            rows = res.fetchmany(BS)
-        return post_comments
+        con = duckdb.connect()
+        con.execute(f"set memory_limit='{DUCKDB_MEMORY}'")
+        glob = f"{self.parquet_root}/*.parquet"
+        [(num_rows,)] = con.execute(f"select count(*) from '{glob}'").fetchall()
+        status = CardStatus(f"# Starting to process: {num_rows} comments in the DB")
+
+        # See hnthreads.py for how comments are linked back to their post.
+        # The end result is a flattened list of comments per post, returned
+        # as a compact CommentStore.
+
+        last = time.perf_counter()
+
+        def on_round(i, mapped):
+            nonlocal last
+            now = time.perf_counter()
+            metrics.observe("resolve round", now - last)
+            last = now
+            status.update(f"## Resolved {mapped} comments after {i} rounds")
+
+        mapped = resolve_threads(con, glob, self.posts, on_round)
+        status.update(force=True)
+        print(f"Mapped {mapped} of {num_rows} comments")
+        with metrics.timer("thread rows"):
+            store = CommentStore.from_batches(thread_rows(con, glob))
+        print(f"{len(store)} posts with comments, {store.nbytes() / 1024**2:.0f}MB")
+        return store
 
     @step
     def end(self):
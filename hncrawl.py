@@ -12,31 +12,76 @@ from metaflow import (
     S3,
     resources,
 )
-from metaflow.cards import Markdown, ProgressBar
-import math, tarfile
-import tempfile, os
+from metaflow.cards import Markdown
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from hnarchive import ArchiveWriter
+from hnmetrics import Metrics, CardStatus, merge_metrics
+from hnstories import iter_posts
+from hnfetch import (
+    Fetcher,
+    host_batches,
+    merge_host_stats,
+    validators_of,
+    conditional_headers,
+    dedupe_urls,
+)
 
 # Flow 2
 # Download HN posts of interest
 #
 # then run or deploy as
-# python hncrawl.py run --with kubernetes --max-workers 100
+# python hncrawl.py --environment=conda run --with kubernetes --max-workers 100
 #
 # Note that you can have a high number for --max-workers as
 # each task hits a different set of websites (no DDOS'ing).
 #
+# Each task keeps --fetch-concurrency requests in flight, while
+# --per-host-rate and --per-host-concurrency limit how hard a
+# single domain is hit from a task.
+#
 # After the run succeeds, tag it with
 #
-#  python hncrawl.py tag add --run-id [YOUR_RUN_ID] crawldata
+#  python hncrawl.py --environment=conda tag add --run-id [YOUR_RUN_ID] crawldata
 #
 # you can choose which crawl to use by moving the tag to
 # a run you like
 #
+# To refresh an existing crawl, run with --incremental. This reuses
+# the tarballs of the crawldata-tagged run and fetches only posts that
+# failed previously or are new. Add --revalidate to also re-request
+# previously downloaded posts with If-None-Match/If-Modified-Since.
+# Tag the new run with crawldata when it succeeds.
+#
 # After this, open hnposts.py
 
-def make_batches(items, n):
-    bs = math.ceil(len(items) / n)
-    return [items[i * bs : (i + 1) * bs] for i in range(n)]
+def previous_host_stats():
+    # Per-host latencies observed by the latest successful crawl, if any
+    try:
+        return Flow("HNSentimentCrawl").latest_successful_run.data.host_stats
+    except:
+        return {}
+
+
+def previous_crawl():
+    # Returns (run id, tarballs, successful ids, validators) of the
+    # crawldata-tagged run. Runs before incremental crawling only have
+    # per-task outputs and no validators.
+    run = list(Flow("HNSentimentCrawl").runs("crawldata"))[0]
+    end = run["end"].task
+    if "tarballs" in end:
+        return (
+            run.id,
+            end["tarballs"].data,
+            end["successful"].data,
+            end["validators"].data,
+        )
+    tarballs, successful = [], set()
+    for task in run["crawl"]:
+        tarballs.append(task["url"].data)
+        successful |= task["successful"].data
+    return run.id, tarballs, successful, {}
 
 
 @project(name="hn_sentiment")
@@ -44,55 +89,169 @@ class HNSentimentCrawl(FlowSpec):
 
     num_parallel = Parameter("num-parallel", default=50)
     max_posts = Parameter("max-posts", default=-1)
+    fetch_concurrency = Parameter("fetch-concurrency", default=64)
+    per_host_rate = Parameter(
+        "per-host-rate", default=2.0, help="Max requests per second per host"
+    )
+    per_host_concurrency = Parameter("per-host-concurrency", default=2)
+    max_batches_per_host = Parameter("max-batches-per-host", default=3)
+    incremental = Parameter("incremental", default=False, is_flag=True)
+    revalidate = Parameter("revalidate", default=False, is_flag=True)
+    max_doc_size = Parameter(
+        "max-doc-size", default=0.0, help="Truncate documents to this many MB (0 = no cap)"
+    )
+    compression = Parameter("compression", default="gz", help="gz or zst")
+    compression_level = Parameter("compression-level", default=6)
+    archive_size = Parameter(
+        "archive-size", default=500.0, help="Start a new archive part after this many MB"
+    )
 
+    @conda(packages={"pyarrow": "16.1.0"})
+    @card(type="blank")
     @step
     def start(self):
         maxp = None if self.max_posts == -1 else self.max_posts
-        posts = Flow("HNSentimentInit").latest_successful_run.data.posts[:maxp]
-        self.batches = make_batches(posts, self.num_parallel)
+        posts = list(iter_posts(["title", "score", "url"], maxp))
+        self.base_crawl_id = None
+        self.base_tarballs = []
+        self.base_successful = set()
+        self.base_validators = {}
+        if self.incremental:
+            (
+                self.base_crawl_id,
+                self.base_tarballs,
+                self.base_successful,
+                self.base_validators,
+            ) = previous_crawl()
+            print(
+                f"Reusing {len(self.base_successful)} posts from crawl {self.base_crawl_id}"
+            )
+        todo = [p for p in posts if p[0] not in self.base_successful]
+        self.known_validators = {}
+        if self.revalidate:
+            self.known_validators = {
+                p[0]: self.base_validators[p[0]]
+                for p in posts
+                if p[0] in self.base_validators
+            }
+            todo += [p for p in posts if p[0] in self.known_validators]
+        todo, self.aliases = dedupe_urls(todo)
+        print(f"{len(todo)} unique urls to fetch")
+        self.batches, self.batch_loads = host_batches(
+            todo, self.num_parallel, previous_host_stats(), self.max_batches_per_host
+        )
+        self.report_batches()
         self.next(self.crawl, foreach="batches")
 
+    def report_batches(self):
+        rows = ["| batch | urls | estimated fetch seconds |", "|---|---|---|"]
+        for i, (batch, load) in enumerate(zip(self.batches, self.batch_loads)):
+            rows.append(f"| {i} | {len(batch)} | {load:.1f} |")
+        mean = sum(self.batch_loads) / max(1, len(self.batch_loads))
+        summary = (
+            f"# Expected load per batch\n\nmax {max(self.batch_loads, default=0):.1f}s, "
+            f"mean {mean:.1f}s"
+        )
+        print(summary)
+        current.card.append(Markdown(summary))
+        current.card.append(Markdown("\n".join(rows)))
+
+    @conda(packages={"requests": "2.32.3", "zstandard": "0.23.0"})
     @resources(disk=1000, cpu=2, memory=4000)
     @card(type="blank")
     @retry
     @step
     def crawl(self):
-        import requests
-
-        self.dir = tempfile.mkdtemp("hncrawl")
         ok = failed = 0
-        status = Markdown("# Starting to download")
-        progress = ProgressBar(max=len(self.input), label="Urls processed")
-        current.card.append(status)
-        current.card.append(progress)
+        metrics = Metrics()
+        status = CardStatus(
+            "# Starting to download",
+            total=len(self.input),
+            label="Urls processed",
+            metrics=metrics,
+        )
         self.successful = set()
         self.failed = set()
-        for i, (id, title, score, url) in enumerate(self.input):
-            try:
-                resp = requests.get(url, allow_redirects=True, timeout=10)
-                resp.raise_for_status()
-                with open(os.path.join(self.dir, str(id)), mode="wb") as f:
-                    f.write(resp.content)
-                self.successful.add(id)
-                ok += 1
-            except:
-                self.failed.add(id)
-                failed += 1
-            if i == len(self.input) - 1 or not i % 20:
-                status.update(f"## Successful downloads {ok}, failed {failed}")
-                progress.update(i + 1)
-                current.card.refresh()
-        tarname = f"crawl-{self.index}.tar.gz"
-        with tarfile.open(tarname, mode="w:gz") as tar:
-            tar.add(self.dir, arcname="data")
-        print(f"file size {os.path.getsize(tarname) / 1024**2}MB")
-        with S3(run=self) as s3:
-            [(_, self.url)] = s3.put_files([(tarname, tarname)])
-            print(f"uploaded {self.url}")
+        self.validators = {}
+        self.unchanged = set()
+        fetcher = Fetcher(
+            concurrency=self.fetch_concurrency,
+            per_host_rate=self.per_host_rate,
+            per_host_inflight=self.per_host_concurrency,
+            max_bytes=int(self.max_doc_size * 1024**2),
+            metrics=metrics,
+        )
+        results = fetcher.fetch_all(
+            self.input,
+            headers_of=lambda p: conditional_headers(self.known_validators.get(p[0])),
+        )
+        # Responses are streamed into archive parts as they arrive. Full
+        # parts are uploaded in the background while the crawl continues.
+        with ThreadPoolExecutor(max_workers=1) as uploader:
+            uploads = []
+            writer = ArchiveWriter(
+                f"crawl-{self.index}",
+                compression=self.compression,
+                level=self.compression_level,
+                max_bytes=int(self.archive_size * 1024**2),
+                on_part=lambda path: uploads.append(uploader.submit(self.upload, path)),
+            )
+            with writer:
+                for i, ((id, title, score, url), res, ex) in enumerate(results):
+                    ids = [id] + self.aliases.get(id, [])
+                    if ex is not None:
+                        self.failed.update(ids)
+                        failed += 1
+                    elif res[0].status_code == 304:
+                        self.unchanged.update(ids)
+                        ok += 1
+                    else:
+                        resp, body = res
+                        validators = validators_of(resp)
+                        with metrics.timer("archive"):
+                            for post_id in ids:
+                                writer.add(str(post_id), body)
+                                if validators:
+                                    self.validators[post_id] = validators
+                        self.successful.update(ids)
+                        ok += 1
+                    status.update(f"## Successful downloads {ok}, failed {failed}", i + 1)
+            self.urls = [fut.result() for fut in uploads]
+        print(f"uploaded {len(self.urls)} archives")
+        status.update(force=True)
+        self.metrics = metrics.to_dict()
+        self.host_stats = dict(fetcher.host_stats)
         self.next(self.join)
 
+    def upload(self, path):
+        print(f"file size {os.path.getsize(path) / 1024**2}MB")
+        with S3(run=self) as s3:
+            [(_, url)] = s3.put_files([(path, path)])
+        os.remove(path)
+        return url
+
     @step
     def join(self, inputs):
+        self.host_stats = merge_host_stats(inp.host_stats for inp in inputs)
+        self.metrics = merge_metrics(inp.metrics for inp in inputs)
+        # Revalidated posts that changed appear both in a base tarball
+        # and in a new one, listed after the base tarballs
+        self.base_crawl_id = inputs[0].base_crawl_id
+        self.tarballs = list(inputs[0].base_tarballs)
+        for inp in inputs:
+            self.tarballs.extend(inp.urls)
+        self.successful = set(inputs[0].base_successful)
+        self.validators = dict(inputs[0].base_validators)
+        failed = set()
+        for inp in inputs:
+            self.successful |= inp.successful
+            self.validators.update(inp.validators)
+            failed |= inp.failed
+        self.failed = failed - self.successful
+        print(
+            f"{len(self.successful)} posts available, {len(self.failed)} failed, "
+            f"{sum(len(inp.unchanged) for inp in inputs)} unchanged"
+        )
         self.next(self.end)
 
     @step
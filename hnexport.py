@@ -0,0 +1,114 @@
+import gzip, json, os, shutil
+from datetime import datetime
+
+# Export of topic data for topic_viewer
+#
+# The viewer used to bundle one topic_data.json with the example posts of
+# every topic, so its size and startup time grew with the number of
+# topics. export_topic_data() instead writes
+#
+#   summary.json          columns id, topic, posts, median, divisiveness
+#                         for all exported topics, loaded at startup
+#   topics/{id}.json.gz   the most negative and positive posts of one
+#                         topic, fetched when the topic is selected
+#
+# The detail files are gzipped once here rather than on every request;
+# the viewer decompresses them itself, so any static file server works.
+# Example posts are picked in SQL with a window over each topic, without
+# loading all posts into Python.
+
+MIN_POSTS = 5
+MIN_COMMENT_TOKENS = 200
+DIVISIVE_MIN_POSTS = 40
+EXAMPLE_POSTS = 5
+
+VIEWER_DATA = os.path.join(os.path.dirname(__file__), "topic_viewer", "public", "topic_data")
+
+
+def _post_entry(post_id, sentiment, time, title):
+    return {
+        "title": title,
+        "url": f"https://news.ycombinator.com/item?id={post_id}",
+        "time": datetime.fromtimestamp(time).strftime("%Y-%m-%d"),
+        "score": int(sentiment),
+    }
+
+
+def topic_examples(store, min_posts=MIN_POSTS, min_comment_tokens=MIN_COMMENT_TOKENS):
+    """Yield (topic_id, num_posts, angry_posts, happy_posts) for topics with
+    more than min_posts posts that have more than min_comment_tokens tokens
+    of comments. The examples are the up to EXAMPLE_POSTS lowest and
+    highest scored of these posts, at most half of them on each side;
+    posts scored >= 7 are never shown as angry."""
+    rows = store.con.execute(
+        """
+        with ranked as (
+            select topic_id, post_id, sentiment, time, title,
+                   row_number() over (partition by topic_id
+                                      order by sentiment, post_id) as rank,
+                   count(*) over (partition by topic_id) as posts
+            from post_topics join posts using (post_id)
+            where sentiment is not null and comment_tokens > $1
+        )
+        select topic_id, posts, rank, post_id, sentiment, time, title
+        from ranked
+        where posts > $2
+              and (rank <= least(posts // 2, $3) or rank > posts - least(posts // 2, $3))
+        order by topic_id, rank
+        """,
+        [min_comment_tokens, min_posts, EXAMPLE_POSTS],
+    ).fetchall()
+    topic = None
+    for topic_id, posts, rank, post_id, sentiment, time, title in rows:
+        if topic_id != topic:
+            if topic is not None:
+                yield topic, num_posts, angry, happy
+            topic, num_posts, angry, happy = topic_id, posts, [], []
+        k = min(posts // 2, EXAMPLE_POSTS)
+        entry = _post_entry(post_id, sentiment, time, title)
+        if rank <= k and sentiment < 7:
+            angry.append(entry)
+        if rank > posts - k:
+            happy.append(entry)
+    if topic is not None:
+        yield topic, num_posts, angry, happy
+
+
+def export_topic_data(
+    store,
+    stats,
+    root=VIEWER_DATA,
+    min_posts=MIN_POSTS,
+    min_comment_tokens=MIN_COMMENT_TOKENS,
+):
+    """Write the summary and the per-topic detail files for topic_viewer
+    to root, replacing an earlier export. store is an Analytics store
+    and stats TopicStats.from_store(store), which provides the median
+    and divisiveness of each topic over all of its posts. Returns the
+    summary columns."""
+    medians = stats.medians()
+    divisiveness = stats.divisiveness()
+    counts = stats.counts()
+    details = os.path.join(root, "topics")
+    if os.path.exists(details):
+        shutil.rmtree(details)
+    os.makedirs(details)
+    summary = {name: [] for name in ("id", "topic", "posts", "median", "divisiveness")}
+    for topic_id, num_posts, angry, happy in topic_examples(
+        store, min_posts, min_comment_tokens
+    ):
+        topic = stats.topics[topic_id]
+        div = float(divisiveness[topic_id]) if counts[topic_id] > DIVISIVE_MIN_POSTS else 0.0
+        summary["id"].append(int(topic_id))
+        summary["topic"].append(topic)
+        summary["posts"].append(int(num_posts))
+        summary["median"].append(int(medians[topic_id]))
+        summary["divisiveness"].append(round(div, 4))
+        detail = {"topic": topic, "angry_posts": angry, "happy_posts": happy}
+        path = os.path.join(details, f"{topic_id}.json.gz")
+        # mtime=0 keeps the files identical across exports of the same data
+        with gzip.GzipFile(path, "wb", compresslevel=9, mtime=0) as f:
+            f.write(json.dumps(detail, separators=(",", ":")).encode("utf-8"))
+    with open(os.path.join(root, "summary.json"), "w") as f:
+        json.dump(summary, f, separators=(",", ":"))
+    return summary
@@ -0,0 +1,268 @@
+import heapq, math, threading, time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+
+# Concurrent, host-polite URL fetching used by hncrawl.py
+#
+# A crawl task spends nearly all of its time waiting on remote hosts,
+# so we keep many requests in flight from a pool of threads, each with
+# its own keep-alive connection pool. Requests to the same host are
+# spaced out by HostLimiter so that a large batch never hammers any
+# single domain.
+
+
+def host_of(url):
+    try:
+        return (urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return ""
+
+
+class HostLimiter:
+    """Allow at most `rate` requests per second and `max_inflight`
+    concurrent requests per host. A rate <= 0 disables spacing."""
+
+    def __init__(self, rate, max_inflight):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.max_inflight = max(1, max_inflight)
+        self.cond = threading.Condition()
+        self.next_slot = {}
+        self.inflight = defaultdict(int)
+
+    def acquire(self, host):
+        with self.cond:
+            while self.inflight[host] >= self.max_inflight:
+                self.cond.wait()
+            self.inflight[host] += 1
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, 0.0))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def release(self, host):
+        with self.cond:
+            self.inflight[host] -= 1
+            self.cond.notify_all()
+
+
+def interleave_by_host(items, url_of):
+    # Round-robin over hosts, so that workers don't all queue up
+    # behind the rate limit of a single popular host
+    queues = defaultdict(deque)
+    for item in items:
+        queues[host_of(url_of(item))].append(item)
+    queues = deque(queues.values())
+    while queues:
+        q = queues.popleft()
+        yield q.popleft()
+        if q:
+            queues.append(q)
+
+
+class Fetcher:
+    def __init__(
+        self,
+        concurrency=64,
+        per_host_rate=2.0,
+        per_host_inflight=2,
+        timeout=10,
+        max_bytes=0,
+        metrics=None,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.limiter = HostLimiter(per_host_rate, per_host_inflight)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # host -> [number of requests, total seconds]
+        self.host_stats = defaultdict(lambda: [0, 0.0])
+
+    def session(self):
+        sess = getattr(self.local, "session", None)
+        if sess is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            sess = requests.Session()
+            adapter = HTTPAdapter(pool_connections=32, pool_maxsize=4)
+            sess.mount("http://", adapter)
+            sess.mount("https://", adapter)
+            self.local.session = sess
+        return sess
+
+    def fetch(self, url, headers=None):
+        host = host_of(url)
+        self.limiter.acquire(host)
+        t = time.monotonic()
+        try:
+            resp = self.session().get(
+                url,
+                headers=headers,
+                allow_redirects=True,
+                timeout=self.timeout,
+                stream=True,
+            )
+            with resp:
+                resp.raise_for_status()
+                return resp, self.read_body(resp)
+        except Exception as ex:
+            if self.metrics:
+                self.metrics.fail("download", ex)
+            raise
+        finally:
+            self.limiter.release(host)
+            elapsed = time.monotonic() - t
+            with self.lock:
+                stats = self.host_stats[host]
+                stats[0] += 1
+                stats[1] += elapsed
+            if self.metrics:
+                self.metrics.observe("download", elapsed)
+
+    def read_body(self, resp):
+        # Stop downloading once max_bytes have been read
+        if not self.max_bytes:
+            return resp.content
+        chunks = []
+        size = 0
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= self.max_bytes:
+                break
+        return b"".join(chunks)[: self.max_bytes]
+
+    def fetch_all(self, items, url_of=lambda item: item[-1], headers_of=None):
+        """Yield (item, (response, body), exception) tuples in completion
+        order. Exactly one of the result and exception is None. At most
+        2 * concurrency fetches are submitted ahead, and a body is dropped
+        as soon as it has been yielded, so memory doesn't grow with the
+        size of the batch."""
+        items = interleave_by_host(items, url_of)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            pending = {}
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < 2 * self.concurrency:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    headers = headers_of(item) if headers_of else None
+                    pending[pool.submit(self.fetch, url_of(item), headers)] = item
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    item = pending.pop(fut)
+                    try:
+                        yield item, fut.result(), None
+                    except Exception as ex:
+                        yield item, None, ex
+
+
+def validators_of(resp):
+    etag = resp.headers.get("ETag")
+    modified = resp.headers.get("Last-Modified")
+    if etag or modified:
+        return etag, modified
+
+
+def conditional_headers(validators):
+    headers = {}
+    if validators:
+        etag, modified = validators
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+    return headers
+
+
+def dedupe_urls(items, url_of=lambda item: item[-1]):
+    """Keep one item per URL. Returns the unique items and a mapping
+    from the id of each kept item to the ids of its duplicates."""
+    first = {}
+    unique = []
+    aliases = defaultdict(list)
+    for item in items:
+        url = url_of(item)
+        if url in first:
+            aliases[first[url]].append(item[0])
+        else:
+            first[url] = item[0]
+            unique.append(item)
+    return unique, dict(aliases)
+
+
+def merge_host_stats(all_stats):
+    merged = defaultdict(lambda: [0, 0.0])
+    for stats in all_stats:
+        for host, (n, secs) in stats.items():
+            merged[host][0] += n
+            merged[host][1] += secs
+    return {host: tuple(v) for host, v in merged.items()}
+
+
+def host_batches(items, n, host_stats=None, max_batches_per_host=3):
+    """Split items into n batches so that posts of the same host stay
+    together in at most `max_batches_per_host` batches, and the estimated
+    fetch cost (URL count times mean past latency of the host) is
+    balanced across batches. Returns (batches, estimated_loads)."""
+    host_stats = host_stats or {}
+    latency = {h: secs / num for h, (num, secs) in host_stats.items() if num}
+    default_latency = (
+        sorted(latency.values())[len(latency) // 2] if latency else 1.0
+    )
+    by_host = defaultdict(list)
+    for item in items:
+        by_host[host_of(item[-1])].append(item)
+
+    def cost(host):
+        return latency.get(host, default_latency)
+
+    total = sum(cost(h) * len(lst) for h, lst in by_host.items())
+    target_cost = total / max(1, n)
+    target_urls = len(items) / max(1, n)
+
+    # Break up hosts that alone would exceed a fair share of one batch,
+    # either by cost or by URL count (a single host is fetched slowly due
+    # to per-host limits), but never across more than max_batches_per_host
+    # batches
+    chunks = []
+    for host, lst in by_host.items():
+        if target_cost:
+            share = max(cost(host) * len(lst) / target_cost, len(lst) / target_urls)
+        else:
+            share = 1
+        k = max(1, min(max_batches_per_host, len(lst), math.ceil(share)))
+        size = math.ceil(len(lst) / k)
+        for i in range(0, len(lst), size):
+            chunk = lst[i : i + size]
+            chunks.append((cost(host) * len(chunk), host, chunk))
+
+    # Longest processing time first: the most expensive chunk goes to
+    # the least loaded batch. Chunks of a host never share a batch.
+    chunks.sort(key=lambda c: c[0], reverse=True)
+    batches = [[] for _ in range(n)]
+    loads = [0.0] * n
+    hosts = [set() for _ in range(n)]
+    heap = [(0.0, i) for i in range(n)]
+    for c, host, chunk in chunks:
+        skipped = []
+        load, i = heapq.heappop(heap)
+        while host in hosts[i] and heap:
+            skipped.append((load, i))
+            load, i = heapq.heappop(heap)
+        batches[i].extend(chunk)
+        loads[i] += c
+        hosts[i].add(host)
+        heapq.heappush(heap, (loads[i], i))
+        for s in skipped:
+            heapq.heappush(heap, s)
+    return batches, loads
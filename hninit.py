@@ -1,32 +1,42 @@
-from metaflow import FlowSpec, IncludeFile, step, conda, project
+
+from metaflow import FlowSpec, IncludeFile, step, conda, project, Flow, Parameter
+
+from hnstories import ingest, save_posts, download_posts
 
 # download story.parquet from
 # https://huggingface.co/datasets/julien040/hacker-news-posts
 #
 # then run or deploy as
 # python hninit.py --package-suffixes .parquet --environment=conda run
+#
+# The posts are stored as a Parquet table sorted by post_id, see
+# hnstories.py. To append only the stories of a newer story.parquet to
+# the table of the latest successful run, run with --incremental
 
 @project(name="hn_sentiment")
 class HNSentimentInit(FlowSpec):
 
+    stories = Parameter("stories", default="story.parquet")
+    since = Parameter("since", default="2020-01-01", help="Ingest stories after this date")
+    incremental = Parameter("incremental", default=False, is_flag=True)
+
     @conda(packages={"duckdb": "1.0.0"})
     @step
     def start(self):
-        import duckdb  # pylint: disable=import-error
-
-        self.posts = (
-            duckdb.query(
-                """
-            select id, title, score, url from 'story.parquet'
-            where score > 20 and
-                  to_timestamp(time) > timestamp '2020-01-01' and
-                  comments > 5 and
-                  url is not null
-        """
-            )
-            .execute()
-            .fetchall()
+        self.base_init_id = previous = watermark = None
+        if self.incremental:
+            run = Flow("HNSentimentInit").latest_successful_run
+            previous = download_posts(run)
+            if previous is None:
+                print(f"Run {run.id} has no post table, ingesting all stories")
+            else:
+                self.base_init_id = run.id
+                watermark = run["end"].task["watermark"].data
+        self.num_posts, num_new, self.watermark = ingest(
+            self.stories, "posts.parquet", self.since, previous, watermark
         )
+        self.posts_url = save_posts(self, "posts.parquet")
+        print(f"{self.num_posts} posts, {num_new} new, watermark {self.watermark}")
         self.next(self.end)
 
     @step
@@ -0,0 +1,172 @@
+import random, threading, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Concurrent LLM requests for the analysis flows
+#
+# LLMScheduler wraps an OpenAI-style chat completion callable, e.g.
+# current.nim.models[MODEL], and has the same call signature, so it can
+# be used as a drop-in replacement. Calls may be made from many threads:
+# the scheduler bounds the number of requests in flight, backs off when
+# the backend returns 429/5xx by halving the concurrency limit (and
+# slowly growing it back on success), and optionally limits the total
+# number of tokens per second with a token bucket.
+
+RETRYABLE = {408, 409, 429}
+
+
+def status_of(ex):
+    for obj in (ex, getattr(ex, "response", None)):
+        for attr in ("status_code", "status"):
+            code = getattr(obj, attr, None)
+            if isinstance(code, int):
+                return code
+
+
+def is_retryable(ex):
+    if isinstance(ex, (TimeoutError, ConnectionError)):
+        return True
+    code = status_of(ex)
+    return code is not None and (code in RETRYABLE or code >= 500)
+
+
+def estimate_tokens(messages, max_tokens):
+    # Rough estimate used before the request is sent. Corrected with
+    # the usage reported by the backend afterwards.
+    chars = sum(len(m.get("content", "")) for m in messages)
+    return chars // 4 + max_tokens
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, n):
+        # Requests larger than the bucket are let through once it is full
+        n = min(n, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, n):
+        # Positive n returns tokens to the bucket, negative n takes more
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + n)
+
+
+class AdaptiveLimit:
+    """Concurrency limit with additive increase, multiplicative decrease."""
+
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.inflight = 0
+        self.pause_until = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                wait = self.pause_until - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                elif self.inflight >= int(self.limit):
+                    self.cond.wait()
+                else:
+                    self.inflight += 1
+                    return
+
+    def release(self, throttled=False, backoff=0.0):
+        with self.cond:
+            self.inflight -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+                self.pause_until = max(self.pause_until, time.monotonic() + backoff)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        llm,
+        concurrency=8,
+        tokens_per_second=0,
+        max_retries=6,
+        backoff=1.0,
+        max_backoff=60.0,
+    ):
+        self.llm = llm
+        self.concurrency = max(1, concurrency)
+        self.limit = AdaptiveLimit(self.concurrency)
+        self.bucket = TokenBucket(tokens_per_second) if tokens_per_second > 0 else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.retries = 0
+
+    def __call__(self, messages, max_tokens, **kwargs):
+        estimate = estimate_tokens(messages, max_tokens)
+        for attempt in range(self.max_retries + 1):
+            if self.bucket:
+                self.bucket.acquire(estimate)
+            self.limit.acquire()
+            try:
+                resp = self.llm(messages=messages, max_tokens=max_tokens, **kwargs)
+            except Exception as ex:
+                if not is_retryable(ex) or attempt == self.max_retries:
+                    self.limit.release()
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2**attempt)
+                delay *= random.uniform(0.5, 1.0)
+                self.limit.release(throttled=True, backoff=delay)
+                with self.lock:
+                    self.retries += 1
+                continue
+            self.limit.release()
+            if self.bucket:
+                used = (resp.get("usage") or {}).get("total_tokens")
+                if used:
+                    self.bucket.adjust(estimate - used)
+            return resp
+
+    def map(self, fn, items):
+        """Run fn over items with up to `concurrency` calls in flight.
+        Yields (item, result, exception) in completion order. Items are
+        consumed lazily, so they may come from a slow generator."""
+        items = iter(items)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            pending = {}
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < 2 * self.concurrency:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[pool.submit(fn, item)] = item
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    item = pending.pop(fut)
+                    try:
+                        yield item, fut.result(), None
+                    except Exception as ex:
+                        yield item, None, ex
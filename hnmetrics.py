@@ -0,0 +1,235 @@
+import contextlib, math, threading, time
+from collections import Counter, defaultdict
+
+# Instrumentation for the long-running tasks
+#
+# Metrics collects, per named stage (download, extract, llm, ...), a
+# histogram of latencies or other positive values such as tokens per
+# second, and counts failures by exception type. Histograms use
+# logarithmic buckets, so they are small and merge exactly across tasks:
+# a task saves Metrics.to_dict() as an artifact, a join merges the dicts
+# of its inputs, and runs can be compared with Metrics.from_dict() in a
+# notebook.
+#
+# CardStatus replaces per-document status.update(), progress.update()
+# and current.card.refresh() calls. Loops call update() as often as
+# they like and the card is redrawn at most every `interval` seconds,
+# with the metrics table below the status line.
+
+# Buckets span a factor of BASE; the midpoint of a bucket is within 9%
+# of any value in it
+BASE = 2**0.25
+ZERO = -(10**6)
+REFRESH_SECONDS = 5.0
+
+
+def _bucket(value):
+    return math.floor(math.log(value, BASE)) if value > 0 else ZERO
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.buckets[_bucket(value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        """Approximate q-quantile, None if the histogram is empty."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                break
+        value = 0.0 if bucket == ZERO else BASE ** (bucket + 0.5)
+        return min(self.max, max(self.min, value))
+
+    def to_dict(self):
+        return {
+            "buckets": dict(self.buckets),
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        hist = cls()
+        # Keys are strings after a round trip through JSON
+        hist.buckets.update({int(b): n for b, n in d["buckets"].items()})
+        hist.count, hist.sum, hist.min, hist.max = d["count"], d["sum"], d["min"], d["max"]
+        return hist
+
+
+def _fmt(value):
+    if value is None:
+        return "-"
+    return f"{value:.3g}"
+
+
+class Metrics:
+    """Per-stage histograms and failure counts. Thread-safe."""
+
+    def __init__(self):
+        self.stages = defaultdict(Histogram)
+        self.failures = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def observe(self, stage, value):
+        with self.lock:
+            self.stages[stage].add(value)
+
+    def fail(self, stage, ex):
+        with self.lock:
+            self.failures[stage][type(ex).__name__] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Time the block as one observation of stage, counting the
+        exception type as a failure if it raises."""
+        t = time.perf_counter()
+        try:
+            yield
+        except Exception as ex:
+            self.fail(stage, ex)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - t)
+
+    def wrap_llm(self, llm, stage="llm"):
+        """Return a callable with the same interface as llm that records
+        the latency of each request in stage, and the total tokens per
+        second in f"{stage} tokens/s" when the backend reports usage."""
+
+        def timed(**kwargs):
+            t = time.perf_counter()
+            with self.timer(stage):
+                resp = llm(**kwargs)
+            tokens = (resp.get("usage") or {}).get("total_tokens")
+            if tokens:
+                self.observe(f"{stage} tokens/s", tokens / (time.perf_counter() - t))
+            return resp
+
+        return timed
+
+    def merge(self, other):
+        with self.lock:
+            for stage, hist in other.stages.items():
+                self.stages[stage].merge(hist)
+            for stage, counts in other.failures.items():
+                self.failures[stage].update(counts)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "stages": {s: h.to_dict() for s, h in self.stages.items()},
+                "failures": {s: dict(c) for s, c in self.failures.items()},
+            }
+
+    @classmethod
+    def from_dict(cls, d):
+        metrics = cls()
+        for stage, hist in d["stages"].items():
+            metrics.stages[stage] = Histogram.from_dict(hist)
+        for stage, counts in d["failures"].items():
+            metrics.failures[stage].update(counts)
+        return metrics
+
+    def table(self):
+        """The metrics as a Markdown table."""
+        with self.lock:
+            rows = [
+                "| stage | count | total | mean | p50 | p90 | p99 | max | failures |",
+                "|---|---|---|---|---|---|---|---|---|",
+            ]
+            for stage in sorted(set(self.stages) | set(self.failures)):
+                hist = self.stages[stage]
+                failures = ", ".join(
+                    f"{name} {n}" for name, n in self.failures[stage].most_common()
+                )
+                values = [hist.sum, hist.mean()]
+                values += [hist.quantile(q) for q in (0.5, 0.9, 0.99)]
+                values += [hist.max if hist.count else None]
+                cells = [stage, str(hist.count)] + [_fmt(v) for v in values]
+                rows.append(f"| {' | '.join(cells + [failures or '-'])} |")
+            return "\n".join(rows)
+
+
+def merge_metrics(dicts):
+    """Merge the Metrics.to_dict() artifacts of several tasks, skipping
+    None (tasks that didn't record metrics)."""
+    merged = Metrics()
+    for d in dicts:
+        if d is not None:
+            merged.merge(Metrics.from_dict(d))
+    return merged.to_dict()
+
+
+class CardStatus:
+    """A status line, an optional progress bar and an optional metrics
+    table on the current card, refreshed at most every interval seconds."""
+
+    def __init__(
+        self, message, total=None, label=None, metrics=None, interval=REFRESH_SECONDS
+    ):
+        from metaflow import current
+        from metaflow.cards import Markdown, ProgressBar
+
+        self.card = current.card
+        self.status = Markdown(message)
+        self.card.append(self.status)
+        self.progress = None
+        if total is not None:
+            self.progress = ProgressBar(max=total, label=label)
+            self.card.append(self.progress)
+        self.metrics = metrics
+        self.table = None
+        if metrics is not None:
+            self.table = Markdown(metrics.table())
+            self.card.append(self.table)
+        self.interval = interval
+        self.message = self.done = None
+        self.last = time.monotonic()
+        self.card.refresh()
+
+    def update(self, message=None, done=None, force=False):
+        """Set the status message and progress, redrawing the card if
+        interval seconds have passed since the last refresh or if force
+        is set. Skipped values are shown by the next redraw."""
+        if message is not None:
+            self.message = message
+        if done is not None:
+            self.done = done
+        now = time.monotonic()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        if self.message is not None:
+            self.status.update(self.message)
+        if self.done is not None and self.progress is not None:
+            self.progress.update(self.done)
+        if self.table is not None:
+            self.table.update(self.metrics.table())
+        self.card.refresh()
@@ -0,0 +1,99 @@
+import re, zlib
+
+# Packed sentiment prompts
+#
+# Most discussions are short, and a request for a short discussion is
+# dominated by per-request overhead: the prompt, the chat template and
+# a full round trip for a 10 token reply. In packed mode, several short
+# discussions go into one prompt as labeled sections, and the model
+# replies with a "POST n: SENTIMENT X" line per section. A reply that
+# doesn't rate every section exactly once is discarded and its posts
+# are rated one at a time, like discussions longer than the packing
+# threshold always are. A sample of packed posts is rated alone too, to
+# measure how well packed ratings agree with single ones.
+
+PACKED_PROMPT = """In the scale between 0-10 where 0 is the most negative sentiment and 10 is the most positive sentiment,
+rank each of the following discussions separately. Each discussion starts with a line "### POST N". Reply with one line per discussion in this format:
+
+POST N: SENTIMENT X
+
+where N is the number of the discussion and X is its sentiment rating
+"""
+
+SECTION = "### POST {}"
+
+# Upper bounds for the tokens of a section header and of a reply line
+SECTION_TOKENS = 8
+REPLY_TOKENS = 10
+
+REPLY = re.compile(r"POST\s*(\d+)\s*:?\s*SENTIMENT\s*(\d+)")
+SINGLE_REPLY = re.compile(r"SENTIMENT (\d+)")
+
+
+def packed_content(prompt, docs):
+    sections = "\n\n".join(
+        f"{SECTION.format(i + 1)}\n{doc}" for i, doc in enumerate(docs)
+    )
+    return f"{prompt}\n---\n{sections}"
+
+
+def parse_sentiment(text):
+    """Return the rating of a single-post reply, or None unless it has
+    exactly one rating, within 0-10."""
+    scores = SINGLE_REPLY.findall(text)
+    if len(scores) != 1 or int(scores[0]) > 10:
+        return None
+    return int(scores[0])
+
+
+def parse_packed(text, n):
+    """Return the ratings of n sections from a packed reply, or None
+    unless each section is rated exactly once, within 0-10."""
+    scores = {}
+    for label, score in REPLY.findall(text):
+        i, score = int(label), int(score)
+        if not 1 <= i <= n or i in scores or score > 10:
+            return None
+        scores[i] = score
+    if len(scores) != n:
+        return None
+    return [scores[i + 1] for i in range(n)]
+
+
+def pack_docs(docs, max_posts, max_doc_tokens, budget):
+    """Group (key, doc, num_tokens) tuples into lists of docs sent in one
+    request. Docs of at most max_doc_tokens tokens are packed in order,
+    up to max_posts per list and budget tokens including section
+    headers; longer docs are yielded alone."""
+    batch, tokens = [], 0
+    for key, doc, num_tokens in docs:
+        if num_tokens > max_doc_tokens:
+            yield [(key, doc, num_tokens)]
+            continue
+        cost = num_tokens + SECTION_TOKENS
+        if batch and (len(batch) == max_posts or tokens + cost > budget):
+            yield batch
+            batch, tokens = [], 0
+        batch.append((key, doc, num_tokens))
+        tokens += cost
+    if batch:
+        yield batch
+
+
+def in_sample(key, rate):
+    """Whether key belongs to a deterministic sample of the given rate."""
+    return zlib.crc32(str(key).encode("utf-8")) % 10000 < rate * 10000
+
+
+def agreement(pairs):
+    """Summary of (packed, single) rating pairs."""
+    n = len(pairs)
+    if not n:
+        return "no packed posts were rated alone"
+    exact = sum(1 for a, b in pairs if a == b)
+    close = sum(1 for a, b in pairs if abs(a - b) <= 1)
+    diff = sum(abs(a - b) for a, b in pairs) / n
+    return (
+        f"{n} packed posts rated alone: {100 * exact / n:.1f}% identical, "
+        f"{100 * close / n:.1f}% within 1, mean absolute difference {diff:.2f}"
+    )
@@ -5,15 +5,24 @@ from metaflow import (
     conda,
     project,
     Flow,
-    S3,
     Parameter,
     current,
     retry,
     card,
+    resources,
 )
-from metaflow.cards import Markdown, ProgressBar
+from metaflow.cards import Markdown
 from metaflow import nim
-import tarfile, os, tempfile, shutil
+
+from hnarchive import open_url, open_stream, iter_documents
+from hnllm import LLMScheduler
+from hnmetrics import Metrics, CardStatus, merge_metrics
+from hntext import extract_files
+from hntokens import load_tokenizer, input_budget, DEFAULT_TOKENIZER
+from hncheckpoint import Checkpoint
+from hncache import load_cache, save_cache, previous_cache_shards, compact_shards
+from hnresults import save_results, load_results, TAGS_SCHEMA
+from hntopics import build_topics
 
 # Flow 3
 # Produce tags for crawled HN posts using an LLM
@@ -21,12 +30,19 @@ import tarfile, os, tempfile, shutil
 # python hnposts.py --environment=conda run --with kubernetes --max-workers 5
 #
 # Note two things:
-# 1. --max-workers controls the concurrency sent to your LLM backend. Going
-#    higher than what the backend can handle is not useful.
+# 1. --max-workers times --llm-concurrency controls the concurrency sent to
+#    your LLM backend. Going higher than what the backend can handle is not
+#    useful, although tasks back off automatically when the backend
+#    responds with 429/5xx. Use --llm-tokens-per-second to cap the token
+#    throughput of each task.
 # 2. Depending on the number of posts to analyze and your LLM backend, this
 #    flow is likely to take 5-10h to run. It makes sense to deploy to Argo
 #    Workflows to keep the run running reliably
 #
+# LLM responses are cached across runs, keyed by prompt, model, document
+# and max_tokens, so rerunning the flow only sends changed documents to
+# the LLM. Run with --llm-cache False to ignore the cache.
+#
 # After this, open hncomments.py
 
 PROMPT = """Assign 10 tags that best describe the following article. Reply only the tags in the following format:
@@ -36,66 +52,153 @@ N. Nth tag"""
 
 MODEL = "meta/llama3-70b-instruct"
 
+MAX_TOKENS = 400
+
 
 @nim(models=[MODEL])
 @project(name="hn_sentiment")
 class HNSentimentAnalyzePosts(FlowSpec):
 
     prompt = Parameter("prompt", default=PROMPT)
-    num_input_tokens = Parameter("num-input-tokens", default=5000)
+    num_input_tokens = Parameter(
+        "num-input-tokens", default=5000, help="Max model tokens per document"
+    )
+    context_window = Parameter("context-window", default=8192)
+    tokenizer = Parameter("tokenizer", default=DEFAULT_TOKENIZER)
+    llm_concurrency = Parameter(
+        "llm-concurrency", default=8, help="LLM requests in flight per task"
+    )
+    llm_tokens_per_second = Parameter(
+        "llm-tokens-per-second", default=0, help="Token budget per task (0 = no limit)"
+    )
+    llm_cache = Parameter("llm-cache", default=True, help="Reuse earlier LLM responses")
+    extract_processes = Parameter(
+        "extract-processes",
+        default=3,
+        help="Processes extracting text per task, leave a CPU for the LLM requests",
+    )
+    checkpoint_interval = Parameter(
+        "checkpoint-interval",
+        default=300,
+        help="Seconds between checkpoints of partial results (0 = disabled)",
+    )
 
     @step
     def start(self):
         crawl_run = list(Flow("HNSentimentCrawl").runs("crawldata"))[0]
         self.crawl_id = crawl_run.id
         print(f"Using data from crawl {self.crawl_id}")
-        self.tarballs = []
-        for task in crawl_run["crawl"]:
-            self.tarballs.append(task["url"].data)
+        end = crawl_run["end"].task
+        if "tarballs" in end:
+            self.tarballs = end["tarballs"].data
+        else:
+            self.tarballs = [task["url"].data for task in crawl_run["crawl"]]
+        self.cache_shards = previous_cache_shards(current.flow_name)
         self.next(self.analyze_posts, foreach="tarballs")
 
+    @resources(cpu=4, memory=4000)
     @card(type="blank")
     @retry
-    @conda(packages={"beautifulsoup4": "4.12.3"})
+    @conda(packages={"zstandard": "0.23.0", "tiktoken": "0.7.0"})
     @step
     def analyze_posts(self):
-        from bs4 import BeautifulSoup  # pylint: disable=import-error
-
-        print("downloading data from", self.input)
-        root = tempfile.mkdtemp("hnpost")
-        with S3() as s3:
-            res = s3.get(self.input)
-            tarfile.open(res.path).extractall(path=root)
-            datapath = os.path.join(root, "data")
-        print("Data extracted ok")
-        status = Markdown("# Starting to analyze")
-        progress = ProgressBar(max=len(os.listdir(datapath)), label="Docs analyzed")
-        current.card.append(status)
-        current.card.append(progress)
-        ok = failed = 0
-        self.post_tags = {}
-        for i, post_id in enumerate(os.listdir(datapath)):
-            with open(os.path.join(datapath, post_id)) as f:
-                try:
-                    tags, num_tokens = self.analyze(f.read(), BeautifulSoup)
-                    self.post_tags[post_id] = (tags, num_tokens)
+        metrics = Metrics()
+        status = CardStatus("# Starting to analyze", metrics=metrics)
+        ckpt = Checkpoint(self, f"analyze_posts-{self.index}", self.checkpoint_interval)
+        # Only analyzed documents are checkpointed, so documents that
+        # failed, e.g. because LLM retries ran out, are retried on resume
+        state = ckpt.load() or {"results": {}}
+        self.post_tags = state["results"]
+        if self.post_tags:
+            print(f"Resuming from a checkpoint with {len(self.post_tags)} docs analyzed")
+        ok = len(self.post_tags)
+        failed = 0
+        llm = LLMScheduler(
+            metrics.wrap_llm(current.nim.models[MODEL]),
+            concurrency=self.llm_concurrency,
+            tokens_per_second=self.llm_tokens_per_second,
+        )
+        cache = load_cache(self.cache_shards if self.llm_cache else [])
+        cached_llm = cache.wrap(llm)
+        tokenizer = load_tokenizer(self.tokenizer)
+        budget = input_budget(
+            tokenizer,
+            f"{self.prompt}\n---\n",
+            self.num_input_tokens,
+            self.context_window,
+            MAX_TOKENS,
+        )
+        print(f"Sending up to {budget} document tokens per request")
+
+        # Documents are read from the archive while it downloads (see
+        # hnarchive.py), text is extracted in a process pool and fed to
+        # the LLM requests as documents become ready. Every word is at
+        # least one token, so extracting `budget` words is always enough.
+        # Hard links point to an earlier post with the same content,
+        # which gets the same tags, so they are resolved at the end.
+        links = {}
+
+        def read_docs(tar):
+            for post_id, data, link in iter_documents(tar):
+                if post_id in self.post_tags:
+                    continue
+                if link is None:
+                    yield post_id, data
+                else:
+                    links[post_id] = link
+
+        def analyze_doc(doc):
+            post_id, words, ex = doc
+            if ex is not None:
+                raise ex
+            return self.analyze(words, cached_llm, tokenizer, budget)
+
+        def update_status(force=False):
+            status.update(
+                f"## Successfully processed {ok} docs, failed {failed}\n\n{cache.summary()}",
+                force=force,
+            )
+
+        print("streaming data from", self.input)
+        with open_url(self.input) as stream:
+            docs = extract_files(
+                read_docs(open_stream(stream)),
+                budget,
+                processes=self.extract_processes,
+                metrics=metrics,
+            )
+            for (post_id, _, _), res, ex in llm.map(analyze_doc, docs):
+                if ex is None:
+                    self.post_tags[post_id] = res
                     ok += 1
-                except Exception as ex:
+                else:
                     failed += 1
+                    metrics.fail("analyze", ex)
                     print(f"analyzing post {post_id} failed: ", ex)
-            status.update(f"## Successfully processed {ok} docs, failed {failed}")
-            progress.update(i + 1)
-            current.card.refresh()
-        shutil.rmtree(root)
+                update_status()
+                ckpt.maybe_save(lambda: {"results": self.post_tags})
+        for post_id, link in links.items():
+            if link in self.post_tags:
+                self.post_tags[post_id] = self.post_tags[link]
+                ok += 1
+            else:
+                failed += 1
+        update_status(force=True)
+        print(f"{llm.retries} LLM requests retried")
+        print(metrics.table())
+        self.metrics = metrics.to_dict()
+        print(cache.summary())
+        print(ckpt.summary())
+        current.card.append(Markdown(ckpt.summary()))
+        self.cache_url = save_cache(cache, self, f"posts-{self.index}.jsonl.gz")
         self.next(self.join)
 
-    def analyze(self, data, BeautifulSoup):
-        soup = BeautifulSoup(data, "html.parser")
-        tokens = soup.get_text().split()[: self.num_input_tokens]
-        doc = " ".join(tokens)
-        llm = current.nim.models[MODEL]
+    def analyze(self, words, llm, tokenizer, budget):
+        doc, num_tokens = tokenizer.truncate(" ".join(words), budget)
         prompt = {"role": "user", "content": f"{self.prompt}\n---\n{doc}"}
-        chat_completion = llm(messages=[prompt], model=MODEL, n=1, max_tokens=400)
+        chat_completion = llm(
+            messages=[prompt], model=MODEL, n=1, max_tokens=MAX_TOKENS
+        )
         s = chat_completion["choices"][0]["message"]["content"]
         tags = []
         for line in s.strip().splitlines():
@@ -106,13 +209,37 @@ class HNSentimentAnalyzePosts(FlowSpec):
             except:
                 print(f"Invalid response format: {s}")
                 break
-        return tags, len(tokens)
+        return tags, num_tokens
 
+    @conda(packages={"pyarrow": "16.1.0"})
     @step
     def join(self, inputs):
-        self.post_tags = {}
-        for inp in inputs:
-            self.post_tags.update(inp.post_tags)
+        # Tags are streamed into a sorted table, see hnresults.py
+        self.post_tags_url, self.post_tags_index = save_results(
+            self, "post_tags", (inp.post_tags for inp in inputs), TAGS_SCHEMA
+        )
+        num_posts = sum(num_rows for _, _, num_rows in self.post_tags_index)
+        print(f"Tags recorded for {num_posts} posts")
+        self.metrics = merge_metrics(inp.metrics for inp in inputs)
+        self.cache_shards = compact_shards(
+            inputs[0].cache_shards + [inp.cache_url for inp in inputs if inp.cache_url],
+            self,
+        )
+        self.next(self.normalize_topics)
+
+    @conda(packages={"pyarrow": "16.1.0", "numpy": "1.26.4"})
+    @step
+    def normalize_topics(self):
+        # Map the free-text tags to a vocabulary of topic ids, see hntopics.py
+        tags = load_results(self.post_tags_url)
+        topics = build_topics(tags.rows(["tags"]))
+        self.topic_vocab = topics["labels"]
+        self.topic_aliases = topics["aliases"]
+        self.post_topics = (topics["post_ids"], topics["offsets"], topics["topic_ids"])
+        print(
+            f"{len(topics['aliases'])} distinct tags normalized to "
+            f"{len(self.topic_vocab)} topics, {topics['junk']} junk tags dropped"
+        )
         self.next(self.end)
 
     @step
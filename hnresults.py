@@ -0,0 +1,204 @@
+import bisect, heapq, itertools, os, shutil, tempfile
+
+# Sorted, columnar results of the analysis flows
+#
+# Instead of merging the per-task result dicts into one big dict
+# artifact, the join steps stream them into a Parquet table sorted by
+# post_id. Each task's results are spilled to disk as a sorted run as
+# soon as they are loaded, and the runs are then merged row group by row
+# group, so the join holds at most one task's results in memory.
+#
+# The first and last post id of each row group form the index: a reader
+# can fetch single posts or id ranges by reading only the row groups
+# that may contain them, and only the columns it needs.
+#
+# PyArrow is imported in functions, as the flows import this module in
+# steps whose environment doesn't include it.
+
+ROW_GROUP_ROWS = 10000
+
+TAGS_SCHEMA = [
+    ("post_id", "int64"),
+    ("tags", "list<string>"),
+    ("num_tokens", "int32"),
+]
+
+SENTIMENT_SCHEMA = [
+    ("post_id", "int64"),
+    ("sentiment", "int8"),
+    ("num_tokens", "int32"),
+]
+
+
+def _schema(fields):
+    import pyarrow as pa  # pylint: disable=import-error
+
+    types = {
+        "int8": pa.int8(),
+        "int32": pa.int32(),
+        "int64": pa.int64(),
+        "list<string>": pa.list_(pa.string()),
+    }
+    return pa.schema([(name, types[t]) for name, t in fields])
+
+
+def _table(rows, schema):
+    import pyarrow as pa  # pylint: disable=import-error
+
+    cols = list(zip(*rows)) if rows else [[] for _ in schema]
+    arrays = [pa.array(col, field.type) for col, field in zip(cols, schema)]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _rows(path):
+    import pyarrow.parquet as pq  # pylint: disable=import-error
+
+    f = pq.ParquetFile(path)
+    for group in range(f.num_row_groups):
+        table = f.read_row_group(group)
+        yield from zip(*(col.to_pylist() for col in table.columns))
+
+
+def write_results(parts, path, fields, row_group_rows=ROW_GROUP_ROWS):
+    """Write results from parts, an iterable of {post_id: tuple of
+    values} dicts, to a Parquet table at path sorted by post_id. fields
+    are (name, type) pairs, post_id first. A post_id in several parts
+    keeps the values of the latest part, like updating one dict with
+    each part would. Only one part is held in memory at a time. Returns
+    the index, [(first, last, num_rows)] of each row group."""
+    import pyarrow.parquet as pq  # pylint: disable=import-error
+
+    schema = _schema(fields)
+    tmp = tempfile.mkdtemp("hnresults")
+    runs = []
+    for i, results in enumerate(parts):
+        rows = sorted((int(post_id),) + tuple(v) for post_id, v in results.items())
+        del results
+        runs.append(os.path.join(tmp, f"run-{i}.parquet"))
+        pq.write_table(_table(rows, schema), runs[-1], row_group_size=row_group_rows)
+        del rows
+    index = []
+    merged = heapq.merge(*(_rows(run) for run in runs), key=lambda row: row[0])
+    # The merge is stable, so the last row of equal ids is from the
+    # latest part
+    merged = (
+        last for _, (*_, last) in itertools.groupby(merged, key=lambda row: row[0])
+    )
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        rows = []
+        for row in merged:
+            rows.append(row)
+            if len(rows) == row_group_rows:
+                writer.write_table(_table(rows, schema), row_group_size=len(rows))
+                index.append((rows[0][0], rows[-1][0], len(rows)))
+                rows = []
+        if rows:
+            writer.write_table(_table(rows, schema), row_group_size=len(rows))
+            index.append((rows[0][0], rows[-1][0], len(rows)))
+    shutil.rmtree(tmp)
+    return index
+
+
+class ResultTable:
+    """Read access to a table written by write_results."""
+
+    def __init__(self, path):
+        import pyarrow.parquet as pq  # pylint: disable=import-error
+
+        self.path = path
+        self.file = pq.ParquetFile(path, memory_map=True)
+        meta = self.file.metadata
+        self.index = []
+        for group in range(meta.num_row_groups):
+            stats = meta.row_group(group).column(0).statistics
+            self.index.append((stats.min, stats.max))
+        self.lasts = [last for _, last in self.index]
+
+    def __len__(self):
+        return self.file.metadata.num_rows
+
+    def _groups(self, first=None, last=None):
+        for group, (lo, hi) in enumerate(self.index):
+            if (first is None or hi >= first) and (last is None or lo <= last):
+                yield group
+
+    def read(self, columns=None, first=None, last=None):
+        """Return a pyarrow Table with the given columns (and post_id) for
+        posts with first <= post_id <= last, reading only the row groups
+        that overlap the range."""
+        import pyarrow as pa  # pylint: disable=import-error
+        import pyarrow.compute as pc  # pylint: disable=import-error
+
+        if columns is not None and "post_id" not in columns:
+            columns = ["post_id"] + list(columns)
+        groups = list(self._groups(first, last))
+        if not groups:
+            return self.file.schema_arrow.empty_table().select(
+                columns or self.file.schema_arrow.names
+            )
+        table = self.file.read_row_groups(groups, columns=columns)
+        mask = None
+        if first is not None:
+            mask = pc.greater_equal(table["post_id"], pa.scalar(first, pa.int64()))
+        if last is not None:
+            upper = pc.less_equal(table["post_id"], pa.scalar(last, pa.int64()))
+            mask = upper if mask is None else pc.and_(mask, upper)
+        return table if mask is None else table.filter(mask)
+
+    def get(self, post_id, columns=None):
+        """Return the row of post_id as a dict, or None if not found."""
+        group = bisect.bisect_left(self.lasts, post_id)
+        if group == len(self.index) or self.index[group][0] > post_id:
+            return None
+        if columns is not None and "post_id" not in columns:
+            columns = ["post_id"] + list(columns)
+        table = self.file.read_row_group(group, columns=columns)
+        ids = table["post_id"].to_pylist()
+        row = bisect.bisect_left(ids, post_id)
+        if row == len(ids) or ids[row] != post_id:
+            return None
+        return {name: table[name][row].as_py() for name in table.column_names}
+
+    def rows(self, columns=None):
+        """Yield rows as tuples (post_id first), one row group at a time."""
+        if columns is not None and "post_id" not in columns:
+            columns = ["post_id"] + list(columns)
+        for group in range(len(self.index)):
+            table = self.file.read_row_group(group, columns=columns)
+            yield from zip(*(col.to_pylist() for col in table.columns))
+
+    def to_dict(self, column):
+        """Return {post_id: value} for one column."""
+        table = self.read([column])
+        return dict(zip(table["post_id"].to_pylist(), table[column].to_pylist()))
+
+
+def save_results(run, name, parts, fields):
+    """Write results with write_results and upload them under
+    results/{name}.parquet. Returns (url, index)."""
+    from metaflow import S3
+
+    path = f"{name}.parquet"
+    index = write_results(parts, path, fields)
+    with S3(run=run) as s3:
+        [(_, url)] = s3.put_files([(f"results/{path}", path)])
+    os.remove(path)
+    return url, index
+
+
+def download_results(url, path=None):
+    """Download a table saved with save_results to path (default: its
+    basename) unless it is already there. Returns the path."""
+    from metaflow import S3
+
+    path = path or os.path.basename(url)
+    if not os.path.exists(path):
+        with S3() as s3:
+            os.rename(s3.get(url).path, path)
+    return path
+
+
+def load_results(url, path=None):
+    """Download a table saved with save_results and return a ResultTable.
+    The file is kept at path (default: its basename) for reuse."""
+    return ResultTable(download_results(url, path))
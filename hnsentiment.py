@@ -11,9 +11,26 @@ from metaflow import (
     retry,
     card,
 )
-from metaflow.cards import Markdown, ProgressBar
+from metaflow.cards import Markdown
 from metaflow import nim, namespace
-import tarfile, os, tempfile, shutil, re
+import os, time
+
+from hncheckpoint import Checkpoint
+from hnshards import CommentShard, skew
+from hnmetrics import Metrics, CardStatus, merge_metrics
+from hnpack import (
+    PACKED_PROMPT,
+    REPLY_TOKENS,
+    packed_content,
+    parse_packed,
+    parse_sentiment,
+    pack_docs,
+    in_sample,
+    agreement,
+)
+from hnresults import save_results, SENTIMENT_SCHEMA
+from hntokens import load_tokenizer, input_budget, DEFAULT_TOKENIZER
+from hncache import load_cache, save_cache, previous_cache_shards, compact_shards
 
 # Flow 5
 # Analyze sentiment of post comments using an LLM
@@ -27,6 +44,20 @@ import tarfile, os, tempfile, shutil, re
 #    flow is likely to take 5-10h to run. It makes sense to deploy to Argo
 #    Workflows to keep the run running reliably
 #
+# As in hnposts.py, LLM responses are cached across runs. Run with
+# --llm-cache False to ignore the cache.
+#
+# Discussions arrive packed by hncomments.py to about --num-input-tokens,
+# sampled across the whole thread (see hnshards.py). Keep the parameter
+# the same in both flows; the text is still truncated to the exact token
+# budget here.
+#
+# With --pack-posts N, up to N discussions of at most --pack-max-tokens
+# tokens are rated in one request (see hnpack.py), which cuts the number
+# of requests for the long tail of short threads. A --pack-sample
+# fraction of packed posts is also rated alone; the agreement between
+# the two is shown on the join card.
+#
 # After this, you have the datasets ready and you can analyze them
 # in a notebook!
 
@@ -40,13 +71,35 @@ where X is the sentiment rating
 
 MODEL = "meta/llama3-70b-instruct"
 
+MAX_TOKENS = 10
+
 
 @nim(models=[MODEL])
 @project(name="hn_sentiment")
 class HNSentimentAnalyzeComments(FlowSpec):
 
     prompt = Parameter("prompt", default=PROMPT)
-    num_input_tokens = Parameter("num-input-tokens", default=3000)
+    num_input_tokens = Parameter(
+        "num-input-tokens", default=3000, help="Max model tokens per discussion"
+    )
+    context_window = Parameter("context-window", default=8192)
+    tokenizer = Parameter("tokenizer", default=DEFAULT_TOKENIZER)
+    llm_cache = Parameter("llm-cache", default=True, help="Reuse earlier LLM responses")
+    checkpoint_interval = Parameter(
+        "checkpoint-interval",
+        default=300,
+        help="Seconds between checkpoints of partial results (0 = disabled)",
+    )
+    packed_prompt = Parameter("packed-prompt", default=PACKED_PROMPT)
+    pack_posts = Parameter(
+        "pack-posts", default=0, help="Max discussions per request (0 = no packing)"
+    )
+    pack_max_tokens = Parameter(
+        "pack-max-tokens", default=500, help="Pack only discussions up to this many tokens"
+    )
+    pack_sample = Parameter(
+        "pack-sample", default=0.05, help="Fraction of packed posts also rated alone"
+    )
 
     @step
     def start(self):
@@ -54,65 +107,206 @@ class HNSentimentAnalyzeComments(FlowSpec):
         comments_run = list(Flow("HNSentimentCommentData").runs("commentresults"))[0]
         self.comments_id = comments_run.id
         print(f"Using comments from {self.comments_id}")
-        self.tarballs = comments_run["end"].task["tarballs"].data
-        self.next(self.analyze_comments, foreach="tarballs")
+        self.shards = comments_run["end"].task["shards"].data
+        try:
+            self.shard_costs = comments_run["end"].task["shard_costs"].data
+        except:
+            self.shard_costs = None
+        self.cache_shards = previous_cache_shards(current.flow_name)
+        self.next(self.analyze_comments, foreach="shards")
 
     @card(type="blank")
     @retry
+    @conda(packages={"tiktoken": "0.7.0", "pyarrow": "16.1.0"})
     @step
     def analyze_comments(self):
+        started = time.time()
+        metrics = Metrics()
         print("downloading data from", self.input)
-        root = tempfile.mkdtemp("hnpost")
-        with S3() as s3:
-            res = s3.get(self.input)
-            tarfile.open(res.path).extractall(path=root)
-            datapath = os.path.join(root, "comments")
-        print("Data extracted ok")
-        status = Markdown("# Starting to analyze")
-        progress = ProgressBar(max=len(os.listdir(datapath)), label="Docs analyzed")
-        current.card.append(status)
-        current.card.append(progress)
-        ok = failed = 0
-        self.post_sentiment = {}
-        for i, post_id in enumerate(os.listdir(datapath)):
-            with open(os.path.join(datapath, post_id)) as f:
+        path = f"comments-{self.index}.parquet"
+        with metrics.timer("download"), S3() as s3:
+            os.rename(s3.get(self.input).path, path)
+        shard = CommentShard(path)
+        print(f"Shard with {len(shard)} posts opened")
+        status = CardStatus(
+            "# Starting to analyze",
+            total=len(shard),
+            label="Docs analyzed",
+            metrics=metrics,
+        )
+        ckpt = Checkpoint(self, f"analyze_comments-{self.index}", self.checkpoint_interval)
+        # Only rated posts are checkpointed, so posts that failed, e.g.
+        # because LLM retries ran out, are retried on resume
+        state = ckpt.load() or {"results": {}}
+        self.post_sentiment = state["results"]
+        # post_id -> (packed rating, single rating)
+        self.pack_agreement = state.get("agreement", {})
+        if self.post_sentiment:
+            print(
+                f"Resuming from a checkpoint with {len(self.post_sentiment)} posts rated"
+            )
+        ok = len(self.post_sentiment)
+        failed = 0
+        cache = load_cache(self.cache_shards if self.llm_cache else [])
+        llm = cache.wrap(metrics.wrap_llm(current.nim.models[MODEL]))
+        tokenizer = load_tokenizer(self.tokenizer)
+        budget = input_budget(
+            tokenizer,
+            f"{self.prompt}\n---\n",
+            self.num_input_tokens,
+            self.context_window,
+            MAX_TOKENS,
+        )
+        pack_posts = max(1, self.pack_posts)
+        # Packed requests fill the context window, short discussions
+        # are well below the single-post budget anyway
+        pack_budget = input_budget(
+            tokenizer,
+            f"{self.packed_prompt}\n---\n",
+            self.context_window,
+            self.context_window,
+            REPLY_TOKENS * pack_posts,
+        )
+        self.pack_stats = {"posts": 0, "requests": 0, "packed": 0, "fallbacks": 0}
+
+        def truncated():
+            for post_id, _, text in shard.items():
+                # Post ids are kept as strings, as they were file names before
+                post_id = str(post_id)
+                if post_id not in self.post_sentiment:
+                    yield (post_id, *tokenizer.truncate(text, budget))
+
+        def rate_packed(batch):
+            # Ratings of a batch in one request, None if that fails
+            self.pack_stats["requests"] += 1
+            self.pack_stats["packed"] += 1
+            try:
+                scores = self.score_packed([doc for _, doc, _ in batch], llm)
+            except Exception as ex:
+                metrics.fail("packed", ex)
+                scores = None
+            if scores is None:
+                self.pack_stats["fallbacks"] += 1
+            return scores
+
+        def rate_single(doc):
+            self.pack_stats["requests"] += 1
+            return self.score(doc, llm)
+
+        batches = pack_docs(truncated(), pack_posts, self.pack_max_tokens, pack_budget)
+        for batch in batches:
+            scores = rate_packed(batch) if len(batch) > 1 else None
+            for i, (post_id, doc, num_tokens) in enumerate(batch):
+                self.pack_stats["posts"] += 1
                 try:
-                    sentiment, num_tokens = self.analyze(f.read())
+                    sentiment = rate_single(doc) if scores is None else scores[i]
                     self.post_sentiment[post_id] = (sentiment, num_tokens)
                     ok += 1
                 except Exception as ex:
                     failed += 1
+                    metrics.fail("analyze", ex)
                     print(f"analyzing comments of post {post_id} failed: ", ex)
-            status.update(f"## Successfully processed {ok} posts, failed {failed}")
-            progress.update(i + 1)
-            current.card.refresh()
-        shutil.rmtree(root)
+                    continue
+                # The packed rating is kept even if rating the post alone
+                # for the agreement check fails
+                if scores is not None and in_sample(post_id, self.pack_sample):
+                    try:
+                        self.pack_agreement[post_id] = (sentiment, rate_single(doc))
+                    except Exception as ex:
+                        metrics.fail("agreement", ex)
+            status.update(
+                f"## Successfully processed {ok} posts, failed {failed}\n\n{cache.summary()}",
+                ok + failed,
+            )
+            ckpt.maybe_save(
+                lambda: {
+                    "results": self.post_sentiment,
+                    "agreement": self.pack_agreement,
+                }
+            )
+        status.update(force=True)
+        print(metrics.table())
+        self.metrics = metrics.to_dict()
+        print(cache.summary())
+        print(ckpt.summary())
+        current.card.append(Markdown(ckpt.summary()))
+        self.cache_url = save_cache(cache, self, f"comments-{self.index}.jsonl.gz")
+        os.remove(path)
+        self.predicted_cost = self.shard_costs[self.index] if self.shard_costs else None
+        self.seconds = time.time() - started
         self.next(self.join)
 
-    def analyze(self, data):
-        parser = re.compile("SENTIMENT (\d)")
-        tokens = data.split()[: self.num_input_tokens]
-        doc = " ".join(tokens)
-        llm = current.nim.models[MODEL]
+    def score(self, doc, llm):
         prompt = {"role": "user", "content": f"{self.prompt}\n---\n{doc}"}
-        chat_completion = llm(messages=[prompt], model=MODEL, n=1, max_tokens=10)
+        chat_completion = llm(
+            messages=[prompt], model=MODEL, n=1, max_tokens=MAX_TOKENS
+        )
         s = chat_completion["choices"][0]["message"]["content"]
-        try:
-            [sentiment_str] = parser.findall(s)
-            sentiment = int(sentiment_str)
-            # print(f"PRMPT {prompt['content']}: {sentiment}")
-        except:
+        sentiment = parse_sentiment(s)
+        if sentiment is None:
             print(f"Invalid output: {s}")
-        return sentiment, len(tokens)
+            raise ValueError("invalid sentiment output")
+        return sentiment
+
+    def score_packed(self, docs, llm):
+        prompt = {"role": "user", "content": packed_content(self.packed_prompt, docs)}
+        chat_completion = llm(
+            messages=[prompt], model=MODEL, n=1, max_tokens=REPLY_TOKENS * len(docs)
+        )
+        return parse_packed(chat_completion["choices"][0]["message"]["content"], len(docs))
 
+    @card(type="blank")
+    @conda(packages={"pyarrow": "16.1.0"})
     @step
     def join(self, inputs):
-        self.post_sentiment = {}
-        for inp in inputs:
-            self.post_sentiment.update(inp.post_sentiment)
-        print(f"Sentiment recorded for {len(self.post_sentiment)} posts")
+        self.report_skew(inputs)
+        self.report_packing(inputs)
+        # Sentiments are streamed into a sorted table, see hnresults.py
+        self.post_sentiment_url, self.post_sentiment_index = save_results(
+            self,
+            "post_sentiment",
+            (inp.post_sentiment for inp in inputs),
+            SENTIMENT_SCHEMA,
+        )
+        num_posts = sum(num_rows for _, _, num_rows in self.post_sentiment_index)
+        self.metrics = merge_metrics(inp.metrics for inp in inputs)
+        self.cache_shards = compact_shards(
+            inputs[0].cache_shards + [inp.cache_url for inp in inputs if inp.cache_url],
+            self,
+        )
+        print(f"Sentiment recorded for {num_posts} posts")
         self.next(self.end)
 
+    def report_skew(self, inputs):
+        # Compare the runtime skew across shards with the skew predicted
+        # from estimated tokens when the shards were built
+        seconds = [inp.seconds for inp in inputs]
+        summary = f"# Shard runtimes\n\nmax {max(seconds):.0f}s, skew {skew(seconds):.2f}"
+        predicted = [inp.predicted_cost for inp in inputs]
+        if None not in predicted:
+            summary += f", predicted skew {skew(predicted):.2f}"
+        print(summary)
+        current.card.append(Markdown(summary))
+
+    def report_packing(self, inputs):
+        # Requests saved by packing, and how packed ratings compare with
+        # rating the same posts alone
+        stats = {}
+        for inp in inputs:
+            for name, n in inp.pack_stats.items():
+                stats[name] = stats.get(name, 0) + n
+        if not stats.get("packed"):
+            return
+        pairs = [pair for inp in inputs for pair in inp.pack_agreement.values()]
+        summary = (
+            f"# Packed prompts\n\n{stats['posts']} posts rated with "
+            f"{stats['requests']} requests ({stats['posts'] / stats['requests']:.1f} "
+            f"posts per request), {stats['fallbacks']} of {stats['packed']} packed "
+            f"requests fell back to single posts\n\n{agreement(pairs)}"
+        )
+        print(summary)
+        current.card.append(Markdown(summary))
+
     @step
     def end(self):
         pass
@@ -0,0 +1,149 @@
+import html
+
+# Columnar comment shards
+#
+# Each shard is a Parquet file with one row per post: post_id, the number
+# of comments, and a ready-to-send text of the thread. Rows are sorted by
+# post_id and grouped into row groups of ROW_GROUP_POSTS posts, so a
+# reader can fetch a single post by reading only its row group from a
+# memory-mapped file, or iterate all posts one row group at a time,
+# without extracting anything to disk.
+#
+# Large threads don't fit in the LLM's input, so the text is packed when
+# the shard is written (see pack_comments): quoted paragraphs and
+# duplicate comments are dropped, and if the thread is still too long, a
+# subset of comments spread evenly over the thread is kept instead of
+# just the earliest ones. The number of comments kept is stored too.
+#
+# PyArrow is imported in functions, as the flows import this module in
+# steps whose environment doesn't include it.
+
+ROW_GROUP_POSTS = 256
+
+# A single comment may take at most this fraction of the packed text
+MAX_COMMENT_SHARE = 0.25
+
+
+def skew(loads):
+    """Max over mean of per-shard loads, 1.0 when perfectly balanced."""
+    mean = sum(loads) / max(1, len(loads))
+    return max(loads, default=0) / mean if mean else 1.0
+
+
+def _schema():
+    import pyarrow as pa  # pylint: disable=import-error
+
+    return pa.schema(
+        [
+            ("post_id", pa.int64()),
+            ("num_comments", pa.int32()),
+            ("num_packed", pa.int32()),
+            ("text", pa.large_string()),
+        ]
+    )
+
+
+def strip_quotes(body):
+    # HN separates paragraphs with <p>, and quotes start with ">"
+    paragraphs = [p for p in body.split("<p>") if not p.lstrip().startswith(">")]
+    return "<p>".join(paragraphs).strip()
+
+
+def spread_order(n):
+    """Return range(n) ordered so that every prefix is spread evenly over
+    the range: 0, n/2, n/4, 3n/4, ... (bit-reversal order)."""
+    bits = max(1, (n - 1).bit_length())
+    return sorted(range(n), key=lambda i: int(f"{i:0{bits}b}"[::-1], 2))
+
+
+def pack_comments(comments, max_chars):
+    """Return a list of comments, in thread order, whose text fits in
+    max_chars characters (0 = no limit). Comments are unescaped, quoted
+    paragraphs and duplicates are dropped, and a long thread is sampled
+    evenly instead of truncated."""
+    cleaned, seen = [], set()
+    for comment in comments:
+        author, _, body = html.unescape(comment).partition("> ")
+        body = strip_quotes(body)
+        if body and body not in seen:
+            seen.add(body)
+            cleaned.append(f"{author}> {body}")
+    if not max_chars or sum(len(c) + 1 for c in cleaned) <= max_chars:
+        return cleaned
+    cap = max(1, int(max_chars * MAX_COMMENT_SHARE))
+    cleaned = [c[:cap] for c in cleaned]
+    keep, room = set(), max_chars
+    for i in spread_order(len(cleaned)):
+        if len(cleaned[i]) + 1 <= room:
+            keep.add(i)
+            room -= len(cleaned[i]) + 1
+    return [c for i, c in enumerate(cleaned) if i in keep]
+
+
+def write_shard(store, post_ids, path, max_chars=0, row_group_posts=ROW_GROUP_POSTS):
+    """Write the comments of post_ids from a CommentStore to a Parquet
+    shard at path, packed to max_chars per post. Returns {post_id:
+    (number of comments, row group)}."""
+    import pyarrow as pa  # pylint: disable=import-error
+    import pyarrow.parquet as pq  # pylint: disable=import-error
+
+    schema = _schema()
+    post_ids = sorted(post_ids)
+    meta = {}
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for group, start in enumerate(range(0, len(post_ids), row_group_posts)):
+            ids = post_ids[start : start + row_group_posts]
+            counts, packed, texts = [], [], []
+            for post_id in ids:
+                comments = store.get(post_id)
+                kept = pack_comments(comments, max_chars)
+                counts.append(len(comments))
+                packed.append(len(kept))
+                texts.append("\n".join(kept))
+                meta[post_id] = (len(comments), group)
+            columns = [
+                pa.array(ids, pa.int64()),
+                pa.array(counts, pa.int32()),
+                pa.array(packed, pa.int32()),
+                pa.array(texts, pa.large_string()),
+            ]
+            table = pa.Table.from_arrays(columns, schema=schema)
+            writer.write_table(table, row_group_size=len(ids))
+    return meta
+
+
+class CommentShard:
+    """Read-only access to a shard written by write_shard."""
+
+    def __init__(self, path):
+        import pyarrow.parquet as pq  # pylint: disable=import-error
+
+        self.file = pq.ParquetFile(path, memory_map=True)
+        self.index = {}
+        for group in range(self.file.num_row_groups):
+            ids = self.file.read_row_group(group, columns=["post_id"]).column(0)
+            for row, post_id in enumerate(ids.to_pylist()):
+                self.index[post_id] = (group, row)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, post_id):
+        return post_id in self.index
+
+    def post_ids(self):
+        return list(self.index)
+
+    def get(self, post_id):
+        """Return (number of comments, text) of post_id."""
+        group, row = self.index[post_id]
+        table = self.file.read_row_group(group, columns=["num_comments", "text"])
+        return table.column(0)[row].as_py(), table.column(1)[row].as_py()
+
+    def items(self):
+        """Yield (post_id, number of comments, text) for all posts, reading
+        one row group at a time."""
+        for group in range(self.file.num_row_groups):
+            columns = ["post_id", "num_comments", "text"]
+            table = self.file.read_row_group(group, columns=columns)
+            yield from zip(*(col.to_pylist() for col in table.columns))
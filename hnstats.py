@@ -0,0 +1,155 @@
+# Vectorized per-topic sentiment statistics
+#
+# Sentiment scores are small integers (0-10), so instead of sorting a
+# list of scores per topic, we reduce all (topic, score) pairs to one
+# histogram matrix of shape (topics, scores) with a single bincount.
+# Counts, medians, tail fractions and divisiveness of all topics are
+# then computed from the histograms and their cumulative sums, so
+# sweeping thresholds doesn't touch the scores again. Bootstrap
+# confidence intervals resample the histograms of all topics at once
+# with multinomial draws.
+#
+# NumPy is imported in functions, like in the other modules.
+
+NUM_SCORES = 11
+
+HIGH_SENTIMENT = 7
+LOW_SENTIMENT = 4
+
+
+def multinomial(rng, n, p, samples):
+    """Draw samples multinomial histograms for each row of p (topics,
+    scores) with n[i] trials, as conditional binomials vectorized over
+    topics and samples. Returns an array of shape (samples, topics,
+    scores)."""
+    import numpy as np  # pylint: disable=import-error
+
+    out = np.zeros((samples,) + p.shape, dtype=np.int64)
+    left = np.broadcast_to(n, (samples, len(n))).copy()
+    mass = np.ones(len(n))
+    for k in range(p.shape[1] - 1):
+        q = np.clip(p[:, k] / np.maximum(mass, 1e-12), 0.0, 1.0)
+        out[..., k] = rng.binomial(left, q)
+        left -= out[..., k]
+        mass = mass - p[:, k]
+    out[..., -1] = left
+    return out
+
+
+class TopicStats:
+    def __init__(self, topics, offsets, scores):
+        """topics is a list of T topic names, scores a flat integer array
+        of the scores of all topics, with the scores of topic i at
+        scores[offsets[i]:offsets[i + 1]]."""
+        import numpy as np  # pylint: disable=import-error
+
+        self.topics = list(topics)
+        scores = np.asarray(scores, dtype=np.int64)
+        sizes = np.diff(np.asarray(offsets, dtype=np.int64))
+        group = np.repeat(np.arange(len(self.topics)), sizes)
+        self.hist = np.bincount(
+            group * NUM_SCORES + scores, minlength=len(self.topics) * NUM_SCORES
+        ).reshape(len(self.topics), NUM_SCORES)
+
+    @classmethod
+    def from_store(cls, store):
+        """Build from the topics and sentiments of an Analytics store."""
+        import numpy as np  # pylint: disable=import-error
+
+        labels = store.con.execute(
+            "select topic from topics order by topic_id"
+        ).fetchnumpy()["topic"]
+        cols = store.con.execute(
+            """
+            select topic_id, sentiment
+            from post_topics join posts using (post_id)
+            where sentiment is not null
+            order by topic_id
+            """
+        ).fetchnumpy()
+        # Topic ids are dense, so offsets follow from their counts
+        counts = np.bincount(cols["topic_id"], minlength=len(labels))
+        return cls(labels, np.r_[0, np.cumsum(counts)], cols["sentiment"])
+
+    def counts(self, hist=None):
+        hist = self.hist if hist is None else hist
+        return hist.sum(axis=-1)
+
+    def medians(self, hist=None):
+        """The upper median score of each topic, -1 for empty topics."""
+        import numpy as np  # pylint: disable=import-error
+
+        hist = self.hist if hist is None else hist
+        cum = hist.cumsum(axis=-1)
+        n = cum[..., -1:]
+        median = (cum <= n // 2).sum(axis=-1)
+        return np.where(n[..., 0] > 0, median, -1)
+
+    def tails(self, high=HIGH_SENTIMENT, low=LOW_SENTIMENT, hist=None):
+        """Number of scores >= high and <= low for each topic."""
+        hist = self.hist if hist is None else hist
+        return hist[..., high:].sum(axis=-1), hist[..., : low + 1].sum(axis=-1)
+
+    def divisiveness(self, high=HIGH_SENTIMENT, low=LOW_SENTIMENT, hist=None):
+        """The share of scores at either tail times how evenly they split
+        between the two tails, 0 for topics without tail scores."""
+        import numpy as np  # pylint: disable=import-error
+
+        hist = self.hist if hist is None else hist
+        num_high, num_low = self.tails(high, low, hist)
+        tail = num_high + num_low
+        n = np.maximum(self.counts(hist), 1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            div = tail / n * (1.0 - np.abs(num_high - num_low) / tail)
+        return np.where(tail > 0, div, 0.0)
+
+    def bootstrap(self, stats, samples=1000, alpha=0.05, seed=0, hist=None, batch=100):
+        """Percentile confidence intervals for each topic, from `samples`
+        resamples of each topic's scores. stats maps names to functions
+        of a (batch, topics, scores) histogram array, e.g. {"median":
+        lambda h: ts.medians(hist=h)}; all of them are computed from the
+        same resamples. Returns {name: (lower, upper)}."""
+        import numpy as np  # pylint: disable=import-error
+
+        hist = self.hist if hist is None else hist
+        rng = np.random.default_rng(seed)
+        n = self.counts(hist)
+        p = hist / np.maximum(n, 1)[:, None]
+        p[n == 0] = 1.0 / NUM_SCORES
+        values = {name: [] for name in stats}
+        for i in range(0, samples, batch):
+            resampled = multinomial(rng, n, p, min(batch, samples - i))
+            for name, stat in stats.items():
+                values[name].append(stat(resampled))
+        quantiles = [alpha / 2, 1 - alpha / 2]
+        return {
+            name: tuple(np.quantile(np.concatenate(v), quantiles, axis=0))
+            for name, v in values.items()
+        }
+
+    def table(self, high=HIGH_SENTIMENT, low=LOW_SENTIMENT, min_posts=1, samples=0):
+        """Statistics of topics with at least min_posts scores as a dict
+        of columns, with bootstrap intervals when samples > 0."""
+        import numpy as np  # pylint: disable=import-error
+
+        keep = self.counts() >= min_posts
+        hist = self.hist[keep]
+        num_high, num_low = self.tails(high, low, hist)
+        columns = {
+            "topic": np.array(self.topics, dtype=object)[keep],
+            "posts": self.counts(hist),
+            "median": self.medians(hist),
+            "high": num_high,
+            "low": num_low,
+            "divisiveness": self.divisiveness(high, low, hist),
+        }
+        if samples:
+            stats = {
+                "median": lambda h: self.medians(h),
+                "divisiveness": lambda h: self.divisiveness(high, low, h),
+            }
+            intervals = self.bootstrap(stats, samples, hist=hist)
+            for name, (lower, upper) in intervals.items():
+                columns[f"{name}_lower"] = lower
+                columns[f"{name}_upper"] = upper
+        return columns
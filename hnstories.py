@@ -0,0 +1,127 @@
+import os
+from itertools import islice
+
+from hnresults import ROW_GROUP_ROWS, ResultTable, download_results
+
+# The post table of HNSentimentInit
+#
+# HNSentimentInit used to fetchall() every qualifying story into Python
+# tuples and pickle them as one artifact, which the crawl and comment
+# flows then unpickled in full. It now writes a Parquet table sorted by
+# post_id with the columns
+#
+#   post_id, title, score, url, time, host
+#
+# in the format of hnresults.py, so readers fetch only the columns and
+# row groups they need through ResultTable. The table is built entirely
+# in DuckDB, which reads only the needed columns of story.parquet and
+# pushes the filters down to skip row groups that can't match.
+#
+# Each run records a watermark, the largest `time` it ingested. An
+# --incremental run reads only stories from the watermark on and appends
+# them to the previous table, so a newer story.parquet snapshot costs
+# time proportional to the new stories. Stories already in the table are
+# kept as they were ingested; their scores aren't updated.
+
+# Like hnfetch.host_of for http(s) URLs: no scheme, userinfo or port
+HOST = r"^[A-Za-z][A-Za-z0-9+.-]*://(?:[^@/?#]*@)?([^:/?#]*)"
+
+# The tuples of self.posts in runs before the post table
+LEGACY_COLUMNS = ("post_id", "title", "score", "url")
+
+
+def ingest(
+    stories,
+    path,
+    since,
+    previous=None,
+    watermark=None,
+    row_group_rows=ROW_GROUP_ROWS,
+):
+    """Write the post table for the stories in the Parquet file stories,
+    posted after the date since, to path. If previous is the path of an
+    earlier table with the given watermark, only stories with time >=
+    watermark that aren't in it are read and appended to it. Returns
+    (num_posts, num_new, watermark)."""
+    import duckdb  # pylint: disable=import-error
+
+    con = duckdb.connect()
+    new = f"""
+        select id as post_id, title, score::int as score, url, time,
+               lower(regexp_extract(url, '{HOST}', 1)) as host
+        from read_parquet($stories)
+        where score > 20 and
+              to_timestamp(time) > $since::timestamp and
+              comments > 5 and
+              url is not null
+    """
+    params = {"stories": stories, "since": since}
+    if previous is None:
+        con.execute(f"create temp table posts as {new}", params)
+        num_new = con.execute("select count(*) from posts").fetchone()[0]
+    else:
+        con.execute(
+            f"""
+            create temp table added as
+            select * from ({new}) as new
+            where time >= $watermark and post_id not in (
+                select post_id from read_parquet($previous) where time >= $watermark
+            )
+            """,
+            dict(params, previous=previous, watermark=watermark),
+        )
+        num_new = con.execute("select count(*) from added").fetchone()[0]
+        con.execute(
+            """
+            create temp table posts as
+            select * from read_parquet($previous) union all by name
+            select * from added
+            """,
+            {"previous": previous},
+        )
+    con.execute(
+        f"""
+        copy (select * from posts order by post_id) to '{path}'
+        (format parquet, compression zstd, row_group_size {int(row_group_rows)})
+        """
+    )
+    num_posts, last = con.execute("select count(*), max(time) from posts").fetchone()
+    con.close()
+    return num_posts, num_new, watermark if last is None else last
+
+
+def save_posts(run, path):
+    """Upload a table written by ingest under posts/ and remove the local
+    file. Returns its url."""
+    from metaflow import S3
+
+    with S3(run=run) as s3:
+        [(_, url)] = s3.put_files([(f"posts/{os.path.basename(path)}", path)])
+    os.remove(path)
+    return url
+
+
+def download_posts(run):
+    """Download the post table of an HNSentimentInit run, or return None
+    if the run predates the table. The file is named after the run, so
+    tables of different runs don't shadow each other."""
+    end = run["end"].task
+    if "posts_url" not in end:
+        return None
+    return download_results(end["posts_url"].data, f"posts-{run.id}.parquet")
+
+
+def iter_posts(columns, max_posts=None):
+    """Yield (post_id, *columns) tuples for the posts of the latest
+    successful HNSentimentInit run in post_id order, at most max_posts of
+    them, reading only the given columns and the row groups needed."""
+    from metaflow import Flow
+
+    run = Flow("HNSentimentInit").latest_successful_run
+    path = download_posts(run)
+    if path is None:
+        indices = [LEGACY_COLUMNS.index(name) for name in ["post_id"] + list(columns)]
+        rows = (tuple(post[i] for i in indices) for post in run.data.posts)
+    else:
+        rows = ResultTable(path).rows(columns)
+    yield from islice(rows, max_posts)
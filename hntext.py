@@ -0,0 +1,130 @@
+import codecs, io, os, queue, time
+from html.parser import HTMLParser
+from multiprocessing import Pool
+
+# Streaming HTML-to-text extraction for crawled pages
+#
+# Instead of building a full document tree, we feed the page to a
+# tokenizing parser in chunks, drop text inside boilerplate elements,
+# and stop reading as soon as max_words words have been collected. Like
+# BeautifulSoup's get_text(), text nodes are concatenated without
+# separators, so words are split only at whitespace.
+
+SKIP_TAGS = frozenset(
+    ["script", "style", "noscript", "template", "svg", "nav", "header", "footer", "aside"]
+)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Enough(Exception):
+    pass
+
+
+class TextExtractor(HTMLParser):
+    def __init__(self, max_words):
+        super().__init__(convert_charrefs=True)
+        self.max_words = max_words
+        self.words = []
+        self.partial = ""
+        self.skip = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip.append(tag)
+
+    def handle_endtag(self, tag):
+        # Tolerate unclosed elements inside skipped ones
+        if tag in self.skip:
+            while self.skip.pop() != tag:
+                pass
+
+    def handle_data(self, data):
+        if self.skip or not data:
+            return
+        words = (self.partial + data).split()
+        if words and not data[-1].isspace():
+            self.partial = words.pop()
+        else:
+            self.partial = ""
+        self.words.extend(words)
+        if len(self.words) >= self.max_words:
+            raise Enough()
+
+    def result(self):
+        if self.partial:
+            self.words.append(self.partial)
+        return self.words[: self.max_words]
+
+
+def extract_words(chunks, max_words):
+    """Return the first max_words words of text in an HTML document
+    given as an iterable of str chunks."""
+    parser = TextExtractor(max_words)
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+    except Enough:
+        pass
+    return parser.result()
+
+
+def read_chunks(f, encoding="utf-8"):
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    while True:
+        data = f.read(CHUNK_SIZE)
+        if not data:
+            yield decoder.decode(b"", final=True)
+            return
+        yield decoder.decode(data)
+
+
+def extract_file(path, max_words):
+    with open(path, "rb") as f:
+        return extract_words(read_chunks(f), max_words)
+
+
+def _extract_job(args):
+    key, doc, max_words = args
+    t = time.perf_counter()
+    try:
+        if isinstance(doc, bytes):
+            words = extract_words(read_chunks(io.BytesIO(doc)), max_words)
+        else:
+            words = extract_file(doc, max_words)
+        return key, words, None, time.perf_counter() - t
+    except Exception as ex:
+        return key, None, ex, time.perf_counter() - t
+
+
+def extract_files(items, max_words, processes=None, max_pending=64, metrics=None):
+    """Extract words from (key, path or bytes) pairs in a pool of
+    processes workers, by default one per CPU this process may run on.
+    Yields (key, words, exception) tuples as documents are processed. At
+    most max_pending documents are taken from items ahead of the
+    consumer, so items may be a lazy stream of document contents.
+    Extraction times and failures are recorded in metrics (see
+    hnmetrics.py) as the "extract" stage."""
+    done = queue.Queue()
+    pending = 0
+
+    def result():
+        key, words, ex, seconds = done.get()
+        if metrics:
+            metrics.observe("extract", seconds)
+            if ex is not None:
+                metrics.fail("extract", ex)
+        return key, words, ex
+
+    if processes is None and hasattr(os, "sched_getaffinity"):
+        processes = len(os.sched_getaffinity(0))
+    with Pool(processes) as pool:
+        for key, doc in items:
+            pool.apply_async(_extract_job, ((key, doc, max_words),), callback=done.put)
+            pending += 1
+            if pending >= max_pending:
+                yield result()
+                pending -= 1
+        for _ in range(pending):
+            yield result()
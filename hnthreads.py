@@ -0,0 +1,219 @@
+# Resolve HN comments to the post they belong to
+#
+# BigQuery's Hacker News table links each comment only to its immediate
+# parent, which may be a post or another comment. Instead of walking the
+# comments in timestamp order in Python, we load the id and parent
+# columns as NumPy arrays and resolve the root post of every comment
+# with pointer jumping: each round, every unresolved comment either
+# picks up the post of the comment it points to, or starts pointing to
+# that comment's parent. The number of rounds grows with the log of the
+# thread depth, and the result does not depend on timestamps, so
+# children that appear before their parents are resolved too.
+#
+# Once resolved, posts are bin-packed into shards by their estimated LLM
+# cost, so that the downstream analysis tasks get about the same amount
+# of work, and each shard (see hnshards.py) is written by its own worker
+# process. Workers are forked after the CommentStore is built, so they
+# share its buffers copy-on-write instead of receiving a pickled copy.
+#
+# NumPy and PyArrow are imported in functions, as the flows import this
+# module in steps whose environment doesn't include them.
+
+import heapq, multiprocessing
+
+from hnshards import write_shard
+from hntokens import CHARS_PER_TOKEN
+
+LIVE = "(dead is null or dead=false) and (deleted is null or deleted=false)"
+
+MAX_ROUNDS = 64
+
+# Estimated cost of a request besides the discussion itself, in tokens:
+# the prompt, the chat template and a short response
+REQUEST_TOKENS = 100
+
+
+def lookup(sorted_keys, values):
+    """Return the positions of values in sorted_keys, -1 where missing."""
+    import numpy as np  # pylint: disable=import-error
+
+    if not len(sorted_keys):
+        return np.full(len(values), -1, dtype=np.int64)
+    pos = np.searchsorted(sorted_keys, values)
+    pos[pos == len(sorted_keys)] = 0
+    return np.where(sorted_keys[pos] == values, pos, -1)
+
+
+def resolve_roots(ids, parents, post_ids, on_round=None):
+    """Given int64 arrays of comment ids and their parents, return an
+    array with the post id of each comment, or -1 for comments that are
+    not under any of post_ids."""
+    import numpy as np  # pylint: disable=import-error
+
+    order = np.argsort(ids, kind="stable")
+    parent_pos = lookup(ids[order], parents)
+    ptr = np.where(parent_pos >= 0, order[parent_pos], -1)
+    posts = np.unique(np.asarray(post_ids, dtype=np.int64))
+    root = np.where(lookup(posts, parents) >= 0, parents, -1)
+    pending = np.flatnonzero((root < 0) & (ptr >= 0))
+    for i in range(MAX_ROUNDS):
+        if not pending.size:
+            break
+        target = ptr[pending]
+        root[pending] = root[target]
+        ptr[pending] = ptr[target]
+        pending = pending[(root[pending] < 0) & (ptr[pending] >= 0)]
+        if on_round:
+            on_round(i + 1, len(ids) - len(pending))
+    return root
+
+
+def resolve_threads(con, parquet_glob, post_ids, on_round=None):
+    """Register a table `comment_posts(id, post_id)` mapping every live
+    comment under one of post_ids to its post. Returns the number of
+    comments mapped. on_round(round, resolved) reports progress."""
+    import numpy as np  # pylint: disable=import-error
+    import pyarrow as pa  # pylint: disable=import-error
+
+    cols = con.execute(
+        f"select id, parent from '{parquet_glob}' where {LIVE}"
+    ).fetchnumpy()
+    ids = np.asarray(cols["id"], dtype=np.int64)
+    parents = np.asarray(cols["parent"], dtype=np.int64)
+    del cols
+    root = resolve_roots(ids, parents, post_ids, on_round)
+    mapped = root >= 0
+    con.register(
+        "comment_posts", pa.table({"id": ids[mapped], "post_id": root[mapped]})
+    )
+    return int(mapped.sum())
+
+
+def thread_rows(con, parquet_glob, batch_size=100000):
+    """Yield Arrow record batches of (post_id, comment) for all mapped
+    comments, ordered by post and timestamp. Requires resolve_threads."""
+    reader = con.execute(
+        "select p.post_id, "
+        "'<' || coalesce(c.\"by\", 'None') || '> ' || coalesce(c.text, 'None') "
+        f"from comment_posts p join '{parquet_glob}' c on p.id = c.id "
+        "order by p.post_id, c.timestamp"
+    ).fetch_record_batch(batch_size)
+    yield from reader
+
+
+class CommentStore:
+    """Comments of all posts in a compact, array-backed form: a sorted
+    int64 array of post ids with offsets into one Arrow string array,
+    which itself is a single bytes buffer plus int64 offsets."""
+
+    def __init__(self, post_ids, post_offsets, comments):
+        self.post_ids = post_ids
+        self.post_offsets = post_offsets
+        self.comments = comments
+
+    @classmethod
+    def from_batches(cls, batches):
+        """Build from record batches of (post_id, comment) ordered by
+        post, as produced by thread_rows."""
+        import numpy as np  # pylint: disable=import-error
+        import pyarrow as pa  # pylint: disable=import-error
+
+        ids, comments = [], []
+        for batch in batches:
+            ids.append(batch.column(0).to_numpy())
+            comments.append(batch.column(1).cast(pa.large_string()))
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        comments = pa.chunked_array(comments, pa.large_string())
+        bounds = np.flatnonzero(np.diff(ids)) + 1
+        starts = np.r_[0, bounds] if len(ids) else np.zeros(0, dtype=np.int64)
+        post_offsets = np.r_[starts, len(ids)].astype(np.int64)
+        return cls(ids[starts].astype(np.int64), post_offsets, comments)
+
+    def __len__(self):
+        return len(self.post_ids)
+
+    def nbytes(self):
+        return self.post_ids.nbytes + self.post_offsets.nbytes + self.comments.nbytes
+
+    def text_lengths(self):
+        """Return the number of characters of each post's comments joined
+        by newlines, aligned with post_ids."""
+        import numpy as np  # pylint: disable=import-error
+        import pyarrow.compute as pc  # pylint: disable=import-error
+
+        lengths = pc.utf8_length(self.comments).to_numpy().astype(np.int64)
+        ends = np.r_[0, np.cumsum(lengths)]
+        counts = np.diff(self.post_offsets)
+        chars = ends[self.post_offsets[1:]] - ends[self.post_offsets[:-1]]
+        return chars + np.maximum(counts - 1, 0)
+
+    def _range(self, post_id):
+        pos = lookup(self.post_ids, [post_id])[0]
+        if pos < 0:
+            return 0, 0
+        return self.post_offsets[pos], self.post_offsets[pos + 1]
+
+    def num_comments(self, post_id):
+        start, end = self._range(post_id)
+        return int(end - start)
+
+    def get(self, post_id):
+        """Return the comments of post_id as a list of strings."""
+        start, end = self._range(post_id)
+        return self.comments.slice(start, end - start).to_pylist()
+
+    def items(self):
+        for i, post_id in enumerate(self.post_ids):
+            start, end = self.post_offsets[i], self.post_offsets[i + 1]
+            yield int(post_id), self.comments.slice(start, end - start).to_pylist()
+
+
+def post_costs(store, post_ids, max_tokens, request_tokens=REQUEST_TOKENS):
+    """Estimate the LLM cost of analyzing each post, in tokens, as its
+    discussion truncated to max_tokens plus request_tokens."""
+    lengths = dict(zip(store.post_ids.tolist(), store.text_lengths().tolist()))
+    return {
+        post_id: min(lengths.get(post_id, 0) // CHARS_PER_TOKEN, max_tokens)
+        + request_tokens
+        for post_id in post_ids
+    }
+
+
+def balance_shards(costs, n):
+    """Split the posts of costs ({post_id: cost}) into n shards of about
+    equal total cost. Returns (shards, loads)."""
+    # Longest processing time first: the most expensive post goes to the
+    # least loaded shard
+    shards = [[] for _ in range(n)]
+    loads = [0] * n
+    heap = [(0, i) for i in range(n)]
+    for post_id, cost in sorted(costs.items(), key=lambda c: (-c[1], c[0])):
+        load, i = heapq.heappop(heap)
+        shards[i].append(post_id)
+        loads[i] = load + cost
+        heapq.heappush(heap, (loads[i], i))
+    return shards, loads
+
+
+# The store shared with forked shard workers, see write_shards
+_STORE = None
+
+
+def _shard_job(args):
+    shard, post_ids, path, max_chars = args
+    return shard, path, write_shard(_STORE, post_ids, path, max_chars)
+
+
+def write_shards(store, shards, path_of, max_chars=0, processes=None):
+    """Write each list of post ids in shards with write_shard in a pool
+    of forked processes. Yields (shard, path, meta) tuples as shards
+    complete."""
+    global _STORE
+
+    jobs = [(i, part, path_of(i), max_chars) for i, part in enumerate(shards)]
+    _STORE = store
+    try:
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            yield from pool.imap_unordered(_shard_job, jobs)
+    finally:
+        _STORE = None
@@ -0,0 +1,67 @@
+# Model-token accounting and truncation for LLM inputs
+#
+# Documents are truncated to a budget of real model tokens rather than
+# whitespace-separated words. Truncation is lazy: we tokenize a growing
+# prefix of the document until it contains more tokens than the budget,
+# so a multi-megabyte document is never tokenized (or split) in full.
+#
+# The default tokenizer is tiktoken's cl100k_base, the BPE vocabulary
+# that Llama 3's tokenizer extends, which counts Llama 3 tokens closely.
+# Names containing a slash are loaded as Hugging Face tokenizers, e.g.
+# meta-llama/Meta-Llama-3-70B-Instruct (requires access to the model).
+
+DEFAULT_TOKENIZER = "cl100k_base"
+
+# Tokens used by the chat template around each message
+MESSAGE_OVERHEAD = 16
+
+CHARS_PER_TOKEN = 4
+
+
+class Tokenizer:
+    def __init__(self, encode, decode):
+        self.encode = encode
+        self.decode = decode
+
+    def count(self, text):
+        return len(self.encode(text))
+
+    def truncate(self, text, budget):
+        """Return (prefix, num_tokens) where prefix is the longest
+        prefix of text that fits in budget tokens."""
+        if budget <= 0:
+            return "", 0
+        window = budget * CHARS_PER_TOKEN
+        while True:
+            tokens = self.encode(text[:window])
+            # The last token of a window may be a fragment cut at the
+            # window boundary, so we need strictly more than the budget
+            if len(tokens) > budget:
+                return self.decode(tokens[:budget]), budget
+            if window >= len(text):
+                return text, len(tokens)
+            window *= 2
+
+
+def load_tokenizer(name=DEFAULT_TOKENIZER):
+    if "/" in name:
+        from tokenizers import Tokenizer as HFTokenizer  # pylint: disable=import-error
+
+        tok = HFTokenizer.from_pretrained(name)
+        return Tokenizer(
+            lambda text: tok.encode(text, add_special_tokens=False).ids,
+            tok.decode,
+        )
+    import tiktoken  # pylint: disable=import-error
+
+    enc = tiktoken.get_encoding(name)
+    return Tokenizer(
+        lambda text: enc.encode(text, disallowed_special=()), enc.decode
+    )
+
+
+def input_budget(tokenizer, prompt, max_input_tokens, context_window, max_tokens):
+    """Tokens available for the document after the prompt, the chat
+    template and the response are packed into the context window."""
+    room = context_window - tokenizer.count(prompt) - MESSAGE_OVERHEAD - max_tokens
+    return max(0, min(max_input_tokens, room))
@@ -0,0 +1,263 @@
+import math, re, unicodedata
+from collections import Counter, defaultdict
+
+# Normalization of LLM-generated tags into a topic vocabulary
+#
+# The tags of HNSentimentAnalyzePosts are free text, so the same topic
+# appears in many forms: "Machine learning", "machine-learning",
+# "Machine Learning models", "ML". We map tags to canonical topics in
+# three passes, using only the standard library:
+#
+# 1. String normalization: Unicode NFKC, lowercase, list numbering,
+#    quotes and punctuation removed, hyphens and underscores as spaces.
+#    Responses that aren't tags (refusals, sentences) are dropped as junk:
+#    refusal phrases anywhere, and words like "article" or "sorry" only
+#    in a sentence, so tags like "Article 13" are kept. A tag whose last
+#    word is a plural is lemmatized to its singular form ("GPUs" -> "gpu")
+#    if that form occurs as a tag too. Names like "postgres" and words
+#    that only look plural, like "news" or "physics", are kept intact.
+# 2. Similarity clustering: tags are processed from the most to the
+#    least frequent. Each one joins the first earlier cluster with the
+#    same form without spaces and dots ("node.js" -> "node js"), or the
+#    most similar one by character trigram Jaccard similarity, using a
+#    prefix-filtered trigram index, provided the numbers in both match
+#    ("python 2" never joins "python 3").
+# 3. Acronyms: a short all-caps tag ("ML") joins the most frequent
+#    multi-word cluster with matching initials.
+#
+# The result is a vocabulary of topic labels and, for each post, an
+# array of topic ids.
+
+MAX_WORDS = 6
+MAX_CHARS = 60
+MIN_SIMILARITY = 0.8
+
+# Matched against normalized tags, so without apostrophes and slashes
+JUNK_PHRASES = re.compile(
+    r"\b(as an ai|as a language model|the text|this text|no content|not available|"
+    r"here are|i cannot|i cant|i am unable|im unable|i apologize|n a)\b"
+)
+JUNK_WORDS = {
+    "article",
+    "provide",
+    "provided",
+    "sorry",
+    "cannot",
+    "cant",
+    "unable",
+    "apologize",
+    "none",
+}
+SENTENCE_WORDS = {"i", "im", "you", "me", "my", "the", "this", "no", "not", "is", "to"}
+
+# Words ending in s that aren't plurals
+NOT_PLURAL_ENDINGS = ("ss", "ics")
+NOT_PLURAL = {"news", "series", "windows", "kubernetes", "postgres", "status", "virus"}
+
+NUMBERS = re.compile(r"\d+")
+LIST_MARKER = re.compile(r"^\s*(\d+[.)]|[-*•])\s*")
+SEPARATORS = re.compile(r"[_\-–—/]+")
+PUNCTUATION = re.compile(r"[^\w\s+#.&]")
+TRAILING_DOTS = re.compile(r"\.(?!\w)")
+
+
+def singular(word):
+    """Candidate singular form of a plural English word."""
+    if len(word) <= 3 or not word.endswith("s"):
+        return word
+    if word in NOT_PLURAL or word.endswith(NOT_PLURAL_ENDINGS):
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("sses", "shes", "ches", "xes", "zes")):
+        return word[:-2]
+    return word[:-1]
+
+
+def normalize(tag):
+    """Return the normalized form of tag, or None if it is junk."""
+    text = unicodedata.normalize("NFKC", tag).lower()
+    text = LIST_MARKER.sub("", text)
+    text = SEPARATORS.sub(" ", text)
+    text = PUNCTUATION.sub("", text)
+    text = TRAILING_DOTS.sub("", text)
+    words = text.split()
+    if not words or len(words) > MAX_WORDS or len(text) > MAX_CHARS:
+        return None
+    if is_junk(words):
+        return None
+    return " ".join(words)
+
+
+def is_junk(words):
+    """Whether normalized words are a refusal or remark, not a tag. A junk
+    word alone or in a sentence is junk, in a name it isn't."""
+    if JUNK_PHRASES.search(" ".join(words)):
+        return True
+    if not JUNK_WORDS.intersection(words):
+        return False
+    return len(words) == 1 or bool(SENTENCE_WORDS.intersection(words))
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def jaccard(a, b):
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+class TopicClusters:
+    """Incremental clustering of normalized tags, see the module comment."""
+
+    def __init__(self, trigram_counts, min_similarity=MIN_SIMILARITY):
+        # Rare trigrams first: two sets with Jaccard similarity >= t
+        # share one of the first len - ceil(t * len) + 1 rarest trigrams
+        self.rank = trigram_counts
+        self.min_similarity = min_similarity
+        self.compact = {}
+        self.index = defaultdict(list)
+        self.grams = []
+        self.numbers = []
+
+    def _prefix(self, grams):
+        ordered = sorted(grams, key=lambda g: (self.rank[g], g))
+        return ordered[: len(grams) - math.ceil(self.min_similarity * len(grams)) + 1]
+
+    def find(self, norm):
+        """Return the cluster id of norm, or None."""
+        cluster = self.compact.get(compact(norm))
+        if cluster is not None:
+            return cluster
+        grams = trigrams(norm)
+        numbers = NUMBERS.findall(norm)
+        best, best_sim = None, self.min_similarity
+        seen = set()
+        for g in self._prefix(grams):
+            for cluster in self.index[g]:
+                if cluster in seen or self.numbers[cluster] != numbers:
+                    continue
+                seen.add(cluster)
+                sim = jaccard(grams, self.grams[cluster])
+                if sim >= best_sim:
+                    best, best_sim = cluster, sim
+        return best
+
+    def add(self, norm):
+        """Start a new cluster represented by norm, returning its id."""
+        cluster = len(self.grams)
+        grams = trigrams(norm)
+        self.compact[compact(norm)] = cluster
+        self.grams.append(grams)
+        self.numbers.append(NUMBERS.findall(norm))
+        for g in self._prefix(grams):
+            self.index[g].append(cluster)
+        return cluster
+
+
+def compact(norm):
+    return re.sub(r"[\s.]", "", norm)
+
+
+def is_capitalized(surfaces):
+    # Whether a tag is mostly written in capitals, like an acronym
+    caps = sum(n for surface, n in surfaces.items() if surface.isupper())
+    return 2 * caps >= sum(surfaces.values())
+
+
+def _label(norm, surfaces):
+    # Keep the case of names like "JavaScript" or "LLMs", otherwise
+    # capitalize the normalized tag like the notebooks did
+    surface = surfaces.most_common(1)[0][0]
+    surface = LIST_MARKER.sub("", surface).strip(" \"'*`")
+    if any(c.isupper() for word in surface.split() for c in word[1:]):
+        return surface
+    return norm.capitalize()
+
+
+def build_topics(post_tags, min_similarity=MIN_SIMILARITY):
+    """Build a topic vocabulary from (post_id, tags) pairs. Returns a dict
+    with the topic labels, the aliases (normalized tag -> topic id),
+    the number of junk tags dropped, and CSR arrays post_ids (sorted),
+    offsets and topic_ids, where the topics of post_ids[i] are
+    topic_ids[offsets[i]:offsets[i + 1]]."""
+    import numpy as np  # pylint: disable=import-error
+
+    posts = {}
+    counts = Counter()
+    surfaces = defaultdict(Counter)
+    normalized = {}
+    junk = 0
+    for post_id, tags in post_tags:
+        norms = set()
+        for tag in tags:
+            if tag not in normalized:
+                normalized[tag] = normalize(tag)
+            norm = normalized[tag]
+            if norm is None:
+                junk += 1
+                continue
+            norms.add(norm)
+            surfaces[norm][tag.strip()] += 1
+        posts[int(post_id)] = norms
+        counts.update(norms)
+
+    lemma_of = {}
+    for norm in list(counts):
+        head, _, last = norm.rpartition(" ")
+        lemma = f"{head} {singular(last)}".strip()
+        if lemma != norm and lemma in counts:
+            lemma_of[norm] = lemma
+    for norm, lemma in lemma_of.items():
+        while lemma in lemma_of:
+            lemma = lemma_of[lemma]
+        lemma_of[norm] = lemma
+    for norm, lemma in lemma_of.items():
+        counts[lemma] += counts.pop(norm)
+        surfaces[lemma].update(surfaces.pop(norm))
+
+    by_count = sorted(counts, key=lambda n: (-counts[n], n))
+    gram_counts = Counter(g for norm in by_count for g in trigrams(norm))
+    clusters = TopicClusters(gram_counts, min_similarity)
+    cluster_of = {}
+    for norm in by_count:
+        cluster = clusters.find(norm)
+        cluster_of[norm] = clusters.add(norm) if cluster is None else cluster
+
+    # Acronyms join the most frequent multi-word cluster with the same
+    # initials, if they are written in capitals
+    by_initials = {}
+    for norm in by_count:
+        words = norm.split()
+        if len(words) > 1:
+            by_initials.setdefault("".join(w[0] for w in words), cluster_of[norm])
+    for norm in by_count:
+        if " " not in norm and 2 <= len(norm) <= 5 and norm in by_initials:
+            if is_capitalized(surfaces[norm]):
+                cluster_of[norm] = by_initials[norm]
+
+    # Renumber clusters so that topic ids are dense, labeled after the
+    # most frequent tag of each cluster
+    founders = {}
+    for norm in by_count:
+        founders.setdefault(cluster_of[norm], norm)
+    topic_of_cluster = {c: i for i, c in enumerate(sorted(founders))}
+    labels = [_label(founders[c], surfaces[founders[c]]) for c in sorted(founders)]
+    aliases = {norm: topic_of_cluster[c] for norm, c in cluster_of.items()}
+    for norm, lemma in lemma_of.items():
+        aliases[norm] = aliases[lemma]
+
+    post_ids = np.array(sorted(posts), dtype=np.int64)
+    topic_lists = [sorted({aliases[n] for n in posts[p]}) for p in post_ids.tolist()]
+    offsets = np.r_[0, np.cumsum([len(t) for t in topic_lists])].astype(np.int64)
+    topic_ids = np.array([t for ts in topic_lists for t in ts], dtype=np.int32)
+    return {
+        "labels": labels,
+        "aliases": aliases,
+        "junk": junk,
+        "post_ids": post_ids,
+        "offsets": offsets,
+        "topic_ids": topic_ids,
+    }
@@ -9,7 +9,32 @@ import {
   type GridApi,
 } from "@ag-grid-community/core";
 import { ModuleRegistry } from "@ag-grid-community/core";
-import topicsData from './topic_data.json';
+
+// Topic data is exported by hnexport.py to public/topic_data: a summary of
+// all topics, loaded at startup, and one gzipped detail file per topic,
+// fetched when the topic is selected.
+const DATA_URL = "topic_data";
+
+interface Summary {
+    id: number[];
+    topic: string[];
+    posts: number[];
+    median: number[];
+    divisiveness: number[];
+}
+
+interface Post {
+    title: string;
+    url: string;
+    time: string;
+    score: number;
+}
+
+interface TopicDetail {
+    topic: string;
+    angry_posts: Post[];
+    happy_posts: Post[];
+}
 
 const sentimentColors = [
     "#6badc9",
@@ -57,21 +82,57 @@ const columnDefs: ColDef[] = [
     }
 ];
 
-function formatData() {
+function formatData(summary: Summary) {
     let data = [];
-    for (let key in topicsData){
-        const e = topicsData[key];
+    for (let i = 0; i < summary.id.length; i++){
         data.push({
-            topic: key,
-            posts: e.num_posts,
-            sentiment: e.median_score,
-            divisive: e.divisiveness.toFixed(2)
+            id: summary.id[i],
+            topic: summary.topic[i],
+            posts: summary.posts[i],
+            sentiment: summary.median[i],
+            divisive: summary.divisiveness[i].toFixed(2)
         });
     }
     return data;
 }
 
-function renderTable(posts) {
+async function fetchJson(url: string) {
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(`${url}: ${response.status}`);
+    }
+    return response.json();
+}
+
+async function fetchDetail(id: number): Promise<TopicDetail> {
+    const url = `${DATA_URL}/topics/${id}.json.gz`;
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(`${url}: ${response.status}`);
+    }
+    const bytes = new Uint8Array(await response.arrayBuffer());
+    // Servers that send the file with Content-Encoding: gzip have
+    // decompressed it already
+    if (bytes[0] !== 0x1f || bytes[1] !== 0x8b) {
+        return JSON.parse(new TextDecoder().decode(bytes));
+    }
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("gzip"));
+    return new Response(stream).json();
+}
+
+const details = new Map<number, Promise<TopicDetail>>();
+
+function loadDetail(id: number) {
+    if (!details.has(id)) {
+        const detail = fetchDetail(id);
+        // Retry on the next selection if the fetch failed
+        detail.catch(() => details.delete(id));
+        details.set(id, detail);
+    }
+    return details.get(id)!;
+}
+
+function renderTable(posts: Post[]) {
     let html = "";
     for (let i in posts){
         const p = posts[i];
@@ -80,31 +141,48 @@ function renderTable(posts) {
                     p.title + "</a></td></tr>";
         html += row;
     }
-    console.log('hey', html);
     return html;
 }
 
-function selectRow(topic) {
-    const e = topicsData[topic];
+let selected: number | undefined;
+
+async function selectRow(id: number, topic: string) {
+    if (id === selected) {
+        return;
+    }
+    selected = id;
     document.querySelector("#topictitle").innerHTML = topic;
     const angryT = document.querySelector("#angry_table") as HTMLElement;
-    angryT.innerHTML = renderTable(e.angry_posts);
     const happyT = document.querySelector("#happy_table") as HTMLElement;
+    angryT.innerHTML = "";
+    happyT.innerHTML = "";
+    let e: TopicDetail;
+    try {
+        e = await loadDetail(id);
+    } catch (err) {
+        console.error(err);
+        if (id === selected) {
+            selected = undefined;
+        }
+        return;
+    }
+    // Another topic may have been selected while this one was loading
+    if (id !== selected) {
+        return;
+    }
+    angryT.innerHTML = renderTable(e.angry_posts);
     happyT.innerHTML = renderTable(e.happy_posts);
 }
 
-const rowData = formatData();
-
 const defaultColDef = {
   resizable: false,
 };
 
 const gridOptions: GridOptions = {
   columnDefs,
-  rowData,
   defaultColDef,
   getRowStyle: p => { return { background: sentimentColors[9 - p.data.sentiment] }},
-  onCellMouseOver: (p) => { selectRow(p.data.topic) },
+  onCellMouseOver: (p) => { selectRow(p.data.id, p.data.topic) },
   //rowHeight: 80,
   //paginationPageSizeSelector: [5, 10, 20],
   //pagination: true,
@@ -121,9 +199,11 @@ const gridOptions: GridOptions = {
 };
 
 document.addEventListener("DOMContentLoaded", function () {
-    console.log('ds');
     const gridDiv = document.querySelector("#app") as HTMLElement;
     gridApi = createGrid(gridDiv, gridOptions);
+    fetchJson(`${DATA_URL}/summary.json`).then((summary: Summary) => {
+        gridApi.setGridOption("rowData", formatData(summary));
+    });
     const filterTextBox = document.getElementById("filter-text-box");
     filterTextBox!.addEventListener("input", (event) => {
         // @ts-ignore